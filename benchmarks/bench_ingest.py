@@ -0,0 +1,149 @@
+"""
+End-to-end ingestion benchmark against the local mock PurpleAir API.
+
+For each number of sensors, starts benchmarks/mock_purpleair.py in its own process, then runs
+get_sensors and get_historicaldata for all its sensors in a fresh working directory (also in its
+own process, so peak RSS is per size). Reports requests/s, rows/s, peak RSS and the time spent
+in the network, parse, merge and write stages. The working directory is removed after the run,
+unless --keep is given.
+
+Run from the repository root:
+
+    python benchmarks/bench_ingest.py --sizes 10,1000,20000 --latency 0.02 --workers 16
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import resource
+import tempfile
+import subprocess
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+def run_client(args):
+    """One benchmark run in the current process; the mock API root comes from PURPLEAIR_API_ROOT."""
+    sys.path.insert(0, REPO_DIR)
+    import purple_air
+
+    workdir = tempfile.mkdtemp(prefix="bench_ingest_")
+    cwd = os.getcwd()
+    try:
+        os.symlink(os.path.join(REPO_DIR, "data"), os.path.join(workdir, "data"))
+        os.chdir(workdir)
+        result = _download(purple_air, args)
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    result["workdir"] = workdir if args.keep else None
+    return result
+
+def _download(purple_air, args):
+    transport = purple_air.PurpleAirTransport(cache_dir=None, pool_size=args.workers)
+
+    start = time.perf_counter()
+    sensors = purple_air.get_sensors("BENCH", transport=transport)
+    sensors_seconds = time.perf_counter() - start
+
+    stats = purple_air.get_historicaldata(
+        sensors_list=sensors['sensor_index'].tolist(),
+        bdate=args.bdate,
+        edate=args.edate,
+        average_time=args.average,
+        key_read="BENCH",
+        sleep_seconds=None,
+        max_workers=args.workers,
+        skip_rules_path=None,
+        transport=transport
+    )
+
+    return {
+        "sensors": len(sensors),
+        "get_sensors_seconds": round(sensors_seconds, 3),
+        "requests": stats["requests"],
+        "rows": stats["rows"],
+        "seconds": stats["seconds"],
+        "requests_per_second": stats["requests_per_second"],
+        "rows_per_second": stats["rows_per_second"],
+        "network_seconds": stats["network_seconds"],
+        "parse_seconds": stats["parse_seconds"],
+        "merge_seconds": stats["merge_seconds"],
+        "write_seconds": stats["write_seconds"],
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def run_size(size, args):
+    port = _free_port()
+    mock = [sys.executable, os.path.join(BENCH_DIR, "mock_purpleair.py"), "--port", str(port),
+            "--sensors", str(size), "--latency", str(args.latency),
+            "--error-rate", str(args.error_rate), "--empty-rate", str(args.empty_rate)]
+    if args.payment_after is not None:
+        mock += ["--payment-after", str(args.payment_after)]
+    server = subprocess.Popen(mock, stdout=subprocess.DEVNULL)
+    api_root = f"http://127.0.0.1:{port}/v1/sensors/"
+    try:
+        # Wait for the server to listen
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(api_root + "?fields=name", timeout=1).read()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        command = [sys.executable, __file__, "--client", "--workers", str(args.workers), "--bdate", args.bdate,
+                   "--edate", args.edate, "--average", str(args.average)] + (["--keep"] if args.keep else [])
+        output = subprocess.run(command, check=True, capture_output=True, text=True,
+                                env=dict(os.environ, PURPLEAIR_API_ROOT=api_root)).stdout
+        return json.loads(output.strip().splitlines()[-1])
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end ingestion benchmark against the mock PurpleAir API.")
+    parser.add_argument("--sizes", default="10,1000,20000", help="comma separated numbers of sensors")
+    parser.add_argument("--workers", type=int, default=16, help="max_workers of get_historicaldata")
+    parser.add_argument("--latency", type=float, default=0.0, help="mock response latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--empty-rate", type=float, default=0.0)
+    parser.add_argument("--payment-after", type=int,
+                        help="history requests the mock serves before returning 402 (default: never)")
+    parser.add_argument("--bdate", default="2021-01-01")
+    parser.add_argument("--edate", default="2021-01-06", help="default: one 5-day window per sensor")
+    parser.add_argument("--average", type=int, default=10)
+    parser.add_argument("--keep", action="store_true", help="keep the working directory of each run")
+    parser.add_argument("--client", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.client:
+        # Keep the download's progress output away from the JSON result
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        result = run_client(args)
+        sys.stdout = stdout
+        print(json.dumps(result))
+        return
+
+    columns = ["sensors", "requests", "rows", "seconds", "requests_per_second", "rows_per_second",
+               "network_seconds", "parse_seconds", "merge_seconds", "write_seconds", "peak_rss_mb"]
+    print("  ".join(f"{column:>19}" for column in columns))
+    for size in [int(size) for size in args.sizes.split(",")]:
+        result = run_size(size, args)
+        print("  ".join(f"{result[column]:>19}" for column in columns))
+        if result["workdir"]:
+            print(f"Kept {result['workdir']}")
+
+if __name__ == "__main__":
+    main()
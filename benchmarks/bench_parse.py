@@ -0,0 +1,118 @@
+"""
+Benchmark: parse time and peak memory per history response.
+
+Compares the old path (response.text -> StringIO -> pd.read_csv -> pd.to_datetime) with
+decode_history (typed pyarrow CSV parse of the raw bytes). The time is the mean over --repeat
+parses. The peak memory is that of one parse, in a fresh process that has only imported the
+modules: the peak of the Python heap (tracemalloc, which also sees NumPy buffers) plus the
+peak of the pyarrow memory pool (max_memory over the bytes allocated before the parse).
+
+Run from the repository root:
+
+    python benchmarks/bench_parse.py --rows 714 --repeat 200
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def make_response(rows, sensor=182):
+    """Synthetic history/csv body with the fields requested by get_historicaldata."""
+    import numpy as np
+    import pandas as pd
+    from purple_air import HISTORY_FIELDS
+
+    rng = np.random.default_rng(0)
+    time_stamps = pd.date_range("2021-01-01", periods=rows, freq="10min").strftime('%Y-%m-%dT%H:%M:%SZ')
+    lines = [",".join(["time_stamp", "sensor_index"] + HISTORY_FIELDS)]
+    values = rng.uniform(0, 100, size=(rows, len(HISTORY_FIELDS))).round(3)
+    for time_stamp, row in zip(time_stamps, values):
+        lines.append(",".join([time_stamp, str(sensor)] + [str(value) for value in row]))
+    return ("\n".join(lines) + "\n").encode()
+
+def parse_old(content):
+    import pandas as pd
+    from io import StringIO
+    df = pd.read_csv(StringIO(content.decode()), sep=",", header=0)
+    df['time_stamp'] = pd.to_datetime(df['time_stamp'], utc=True)
+    return df
+
+def parse_new(content):
+    from purple_air import decode_history
+    return decode_history(content)
+
+PARSERS = {"old": parse_old, "new": parse_new}
+
+def time_path(path, content, repeat):
+    """Mean milliseconds per parse, after one parse to warm up imports and caches."""
+    parse = PARSERS[path]
+    parse(content)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        parse(content)
+    return round(1000 * (time.perf_counter() - start) / repeat, 3)
+
+def measure_path(path, content):
+    """Peak memory (KB) of a single parse; run it in a fresh process that has not parsed anything yet."""
+    # Imports first, so that their allocations are not counted
+    import pandas
+    import pyarrow as pa
+    import purple_air
+
+    pool = pa.default_memory_pool()
+    arrow_before = pool.bytes_allocated()
+    tracemalloc.start()
+    result = PARSERS[path](content)
+    python_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    arrow_peak = max(0, pool.max_memory() - arrow_before)
+    del result
+    return {"python_peak_kb": python_peak // 1024, "arrow_peak_kb": arrow_peak // 1024,
+            "peak_kb": (python_peak + arrow_peak) // 1024}
+
+def _run(*args):
+    output = subprocess.run([sys.executable, __file__] + [str(arg) for arg in args],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=714, help="rows per response (default: 714)")
+    parser.add_argument("--repeat", type=int, default=200, help="responses parsed per path (default: 200)")
+    parser.add_argument("--path", choices=list(PARSERS), help=argparse.SUPPRESS)
+    parser.add_argument("--content", help=argparse.SUPPRESS)
+    parser.add_argument("--measure", choices=["time", "memory"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.path:
+        with open(args.content, "rb") as content_file:
+            content = content_file.read()
+        if args.measure == "time":
+            print(json.dumps({"ms_per_response": time_path(args.path, content, args.repeat)}))
+        else:
+            print(json.dumps(measure_path(args.path, content)))
+        return
+
+    # The response is written once, so the measured processes do not build it
+    with tempfile.TemporaryDirectory() as workdir:
+        content_path = os.path.join(workdir, "response.csv")
+        with open(content_path, "wb") as content_file:
+            content_file.write(make_response(args.rows))
+        n_bytes = os.path.getsize(content_path)
+
+        print(f"{'path':<6}{'rows':>8}{'bytes':>10}{'ms/response':>14}{'peak KB (Python + Arrow)':>30}")
+        for path in PARSERS:
+            timing = _run("--path", path, "--content", content_path, "--measure", "time", "--repeat", args.repeat)
+            memory = _run("--path", path, "--content", content_path, "--measure", "memory")
+            peak = f"{memory['peak_kb']} ({memory['python_peak_kb']} + {memory['arrow_peak_kb']})"
+            print(f"{path:<6}{args.rows:>8}{n_bytes:>10}{timing['ms_per_response']:>14}{peak:>30}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark: startup time of the purple_air.py command line.
+
+Times fresh interpreter runs of the subcommands that start without network or downloads
+(`--help`, `status`, `plan --help`) and of a bare `import purple_air`, and checks that neither
+the geometry stack (geopandas, shapely, pyogrio, fiona, pyproj), which only refresh-index needs,
+nor pandas, NumPy or pyarrow, which only the commands that read or write data need, is imported
+by them. Exits with 1 on a heavy import, or when a median exceeds --max-ms,
+so it can guard against regressions in CI or before a SLURM array submission.
+
+Run from the repository root:
+
+    python benchmarks/bench_startup.py --repeat 10 --max-ms 1500
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(REPO_DIR, "purple_air.py")
+
+# Modules that history-only commands must not import
+GEOMETRY_MODULES = ["geopandas", "shapely", "pyogrio", "fiona", "pyproj"]
+# Modules that the import, --help and status must not import
+DATA_MODULES = ["pandas", "numpy", "pyarrow"]
+
+COMMANDS = {
+    "import": [sys.executable, "-c", "import sys; sys.path.insert(0, %r); import purple_air" % REPO_DIR],
+    "--help": [sys.executable, SCRIPT, "--help"],
+    "plan --help": [sys.executable, SCRIPT, "plan", "--help"],
+    "status": [sys.executable, SCRIPT, "status", "--log-file", "missing.sqlite"]
+}
+
+# Checked for heavy imports: None is a bare import, otherwise the arguments of main()
+CHECKED = {"import": None, "--help": ["--help"], "status": ["status", "--log-file", "missing.sqlite"]}
+
+def loaded_modules(argv, workdir):
+    """Top-level modules imported by `import purple_air` and main(argv), from a fresh interpreter."""
+    code = ("import sys, json, io, contextlib; sys.path.insert(0, %r); import purple_air\n"
+            "if %r is not None:\n"
+            "    with contextlib.redirect_stdout(io.StringIO()):\n"
+            "        try: purple_air.main(%r)\n"
+            "        except SystemExit: pass\n"
+            "print(json.dumps(sorted({name.split('.')[0] for name in sys.modules})))" % (REPO_DIR, argv, argv))
+    result = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True, cwd=workdir)
+    return json.loads(result.stdout)
+
+def time_command(command, repeat, workdir):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, cwd=workdir, stdout=subprocess.DEVNULL)
+        timings.append(1000 * (time.perf_counter() - start))
+    return statistics.median(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time of the purple_air.py command line.")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per command (default: 5)")
+    parser.add_argument("--max-ms", type=float, help="fail when a median startup time is above this")
+    args = parser.parse_args()
+
+    failed = False
+    baseline = time_command([sys.executable, "-c", "pass"], args.repeat, REPO_DIR)
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, argv in CHECKED.items():
+            modules = loaded_modules(argv, workdir)
+            heavy = [module for module in GEOMETRY_MODULES + DATA_MODULES if module in modules]
+            if heavy:
+                print(f"FAIL: {name} loads {', '.join(heavy)}")
+                failed = True
+
+        print(f"{'command':<14}{'median ms':>12}{'over python -c pass':>22}")
+        for name, command in COMMANDS.items():
+            median = time_command(command, args.repeat, workdir)
+            print(f"{name:<14}{median:>12.1f}{median - baseline:>22.1f}")
+            if args.max_ms is not None and median > args.max_ms:
+                print(f"FAIL: {name} takes {median:.1f} ms (limit: {args.max_ms} ms)")
+                failed = True
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Local stand-in for the PurpleAir API, for benchmarks and debugging without spending API points.
+
+Serves synthetic data for:
+
+    GET /v1/sensors/                               sensor list (fields, modified_since, show_only)
+    GET /v1/sensors/{sensor_index}/history/csv     history (start_timestamp, end_timestamp, average, fields)
+
+with configurable latency, error rate, empty windows, 402 payment errors and rejected API keys
+(401 or 403). Run it standalone:
+
+    python benchmarks/mock_purpleair.py --sensors 1000 --latency 0.05
+    PURPLEAIR_API_ROOT=http://127.0.0.1:8123/v1/sensors/ python purple_air.py
+
+or start it in-process with start_mock_server().
+"""
+
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+class MockConfig:
+    """Behaviour of the mock server."""
+
+    def __init__(self, n_sensors=1000, latency=0.0, error_rate=0.0, empty_rate=0.0, payment_after=None, seed=0,
+                 rejected_keys=None):
+        self.n_sensors = n_sensors          # sensors 1..n_sensors
+        self.latency = latency              # seconds added to every response
+        self.error_rate = error_rate        # share of history requests answered with a 500
+        self.empty_rate = empty_rate        # share of history windows with no data (header only)
+        self.payment_after = payment_after  # history requests served before every request gets a 402
+        self.seed = seed
+        self.rejected_keys = dict(rejected_keys or {})  # api_key -> 401 (invalid key) or 403 (wrong key type)
+        self.history_requests = 0
+        self.lock = threading.Lock()
+
+def _sensor_random(config, sensor, salt=""):
+    # Stable per-sensor randomness, independent of the request order
+    digest = hashlib.sha256(f"{config.seed}:{sensor}:{salt}".encode()).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+def _parse_time(value):
+    if value.isdigit():
+        return int(value)
+    return int(datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp())
+
+def _last_seen(config, sensor, now):
+    # Each sensor reports every period seconds (most every 2 minutes, some hourly), at its own offset
+    rng = _sensor_random(config, sensor, "last_seen")
+    period = rng.choice([120, 120, 120, 3600])
+    return now - (now + rng.randint(0, period - 1)) % period
+
+def sensor_row(config, sensor, fields, now):
+    rng = _sensor_random(config, sensor)
+    values = {
+        "sensor_index": sensor,
+        "name": f"Mock sensor {sensor}",
+        "location_type": int(rng.random() < 0.2),
+        "latitude": round(rng.uniform(25, 49), 6) if rng.random() < 0.8 else round(rng.uniform(-60, 70), 6),
+        "longitude": round(rng.uniform(-124, -67), 6) if rng.random() < 0.8 else round(rng.uniform(-180, 180), 6),
+        "altitude": rng.randint(0, 3000),
+        "position_rating": rng.randint(0, 5),
+        "uptime": rng.randint(0, 100000),
+        "last_seen": _last_seen(config, sensor, now),
+        "last_modified": now - rng.randint(0, 86400 * 365),
+        "date_created": now - rng.randint(86400 * 365, 86400 * 365 * 6),
+    }
+    # Measurements change with every reading
+    readings = _sensor_random(config, sensor, values["last_seen"])
+    for field in fields:
+        if field not in values:
+            values[field] = round(readings.uniform(0, 80), 1)
+    return [values[field] for field in fields]
+
+def history_csv(config, sensor, start, end, average, fields):
+    rng = _sensor_random(config, sensor, f"{start}:{end}")
+    if rng.random() < config.empty_rate:
+        return ",".join(["time_stamp", "sensor_index"] + fields) + "\n"
+    step = max(int(average), 2) * 60
+    lines = [",".join(["time_stamp", "sensor_index"] + fields)]
+    for time_stamp in range(start - start % step + (step if start % step else 0), end, step):
+        row = [datetime.fromtimestamp(time_stamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'), str(sensor)]
+        row += [f"{rng.uniform(0, 80):.3f}" for _ in fields]
+        lines.append(",".join(row))
+    return "\n".join(lines) + "\n"
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type):
+        body = body.encode() if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, error, description):
+        self._send(status, json.dumps({"api_version": "mock", "error": error, "description": description}),
+                   "application/json")
+
+    def do_GET(self):
+        config = self.config
+        if config.latency:
+            time.sleep(config.latency)
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        fields = [field for field in query.get("fields", "").split(",") if field]
+
+        status = config.rejected_keys.get(query.get("api_key"))
+        if status == 401:
+            self._send_error(401, "InvalidApiKeyError", "The provided api_key was not valid.")
+            return
+        if status is not None:
+            self._send_error(status, "ApiKeyTypeMismatchError", "The provided api_key type is not allowed.")
+            return
+
+        if re.fullmatch(r"/v1/sensors/?", url.path):
+            now = int(time.time())
+            sensors = range(1, config.n_sensors + 1)
+            if "show_only" in query:
+                sensors = [int(sensor) for sensor in query["show_only"].split(",")
+                           if sensor.isdigit() and 1 <= int(sensor) <= config.n_sensors]
+            fields = ["sensor_index"] + [field for field in fields if field != "sensor_index"]
+            data = [sensor_row(config, sensor, fields, now) for sensor in sensors]
+            if "modified_since" in query:
+                # A fixed 5% of the sensors counts as modified since any time stamp
+                data = [row for row, sensor in zip(data, sensors)
+                        if _sensor_random(config, sensor, "modified").random() < 0.05]
+            body = {"api_version": "mock", "time_stamp": now, "data_time_stamp": now, "max_age": 604800,
+                    "fields": fields, "data": data}
+            self._send(200, json.dumps(body), "application/json")
+            return
+
+        match = re.fullmatch(r"/v1/sensors/(\d+)/history/csv", url.path)
+        if match:
+            with config.lock:
+                config.history_requests += 1
+                n_requests = config.history_requests
+            if config.payment_after is not None and n_requests > config.payment_after:
+                self._send_error(402, "PaymentRequiredError", "Payment is required to make this api call.")
+                return
+            if random.random() < config.error_rate:
+                self._send_error(500, "InternalServerError", "Mock server error.")
+                return
+            sensor = int(match.group(1))
+            if not 1 <= sensor <= config.n_sensors:
+                self._send_error(404, "NotFoundError", "Cannot find a sensor with the provided parameters.")
+                return
+            body = history_csv(config, sensor, _parse_time(query["start_timestamp"]), _parse_time(query["end_timestamp"]),
+                               int(query.get("average", 10)), fields)
+            self._send(200, body, "text/csv")
+            return
+
+        self._send_error(404, "NotFoundError", "Unknown path.")
+
+def start_mock_server(host="127.0.0.1", port=0, **config):
+    """
+    Start the mock server in a background thread.
+
+    Returns the server (server.shutdown() stops it), its MockConfig and the API root URL to use
+    as purple_air.API_ROOT_URL.
+    """
+    mock_config = MockConfig(**config)
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"config": mock_config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, mock_config, f"http://{host}:{server.server_address[1]}/v1/sensors/"
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the PurpleAir API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8123)
+    parser.add_argument("--sensors", type=int, default=1000, help="number of sensors (default: 1000)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of history requests answered with a 500")
+    parser.add_argument("--empty-rate", type=float, default=0.0, help="share of history windows with no data")
+    parser.add_argument("--payment-after", type=int, help="history requests served before returning 402")
+    parser.add_argument("--reject-key", action="append", default=[], metavar="KEY:STATUS",
+                        help="answer requests with this api_key with STATUS (401 or 403); repeatable")
+    args = parser.parse_args()
+    rejected_keys = {key: int(status) for key, status in (item.rsplit(":", 1) for item in args.reject_key)}
+
+    server, _, api_root = start_mock_server(args.host, args.port, n_sensors=args.sensors, latency=args.latency,
+                                            error_rate=args.error_rate, empty_rate=args.empty_rate,
+                                            payment_after=args.payment_after, rejected_keys=rejected_keys)
+    print(f"Mock PurpleAir API: PURPLEAIR_API_ROOT={api_root}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -1,100 +1,863 @@
 import os
+import sys
 import json
 import time
+import threading
+import signal
 import requests
-import pandas as pd
-import geopandas as gpd
-from io import StringIO
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime, timedelta, timezone
 import glob
+import gzip
+import hashlib
+import functools
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import argparse
+import bisect
+import re
+import cProfile
+import pstats
+from contextlib import contextmanager
+import calendar
+import sqlite3
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# Function to update the log file with the last download date and sensor info
-def update_sensor_index_log(log_file_path, sensor_list, last_download_date):
-    log_data = {}
+# PurpleAir API URL (PURPLEAIR_API_ROOT points the module at another server, e.g. benchmarks/mock_purpleair.py)
+API_ROOT_URL = os.environ.get("PURPLEAIR_API_ROOT", "https://api.purpleair.com/v1/sensors/")
+
+# Default location of the download log
+LOG_FILE_PATH = 'sensor_log.sqlite'
+
+# Download log written by earlier versions of this script
+LEGACY_LOG_FILE_PATH = 'sensor_log.json'
+
+class SensorLog:
+    """
+    Transactional download log stored in SQLite.
+
+    Keeps the same per-sensor fields as the old sensor_log.json (min_date, max_date,
+    url_issue, no_data and skipped), but every update is its own small transaction,
+    so a crash or a SLURM timeout only loses the window that was running. The database
+    runs in WAL mode: other processes can read it while a download is writing to it.
+
+    With read_only, the log is copied into memory (an empty log if the file does not exist):
+    updates, and the schema upgrade of an older log, never reach the file.
+    """
+
+    def __init__(self, db_path=LOG_FILE_PATH, read_only=False):
+        self.db_path = db_path
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        if read_only:
+            self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+            if os.path.exists(db_path):
+                source = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=60)
+                source.backup(self.conn)
+                source.close()
+        else:
+            self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        has_coverage = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'coverage'").fetchone() is not None
+        with self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                CREATE TABLE IF NOT EXISTS sensors (
+                    sensor_index INTEGER PRIMARY KEY,
+                    min_date TEXT,
+                    max_date TEXT,
+                    skipped INTEGER NOT NULL DEFAULT 0,
+                    rows INTEGER NOT NULL DEFAULT 0,
+                    row_seconds INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS url_issue (
+                    sensor_index INTEGER NOT NULL,
+                    message TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS url_issue_sensor ON url_issue (sensor_index);
+                CREATE TABLE IF NOT EXISTS no_data (
+                    sensor_index INTEGER NOT NULL,
+                    window TEXT NOT NULL,
+                    PRIMARY KEY (sensor_index, window)
+                );
+                CREATE TABLE IF NOT EXISTS coverage (
+                    sensor_index INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    start INTEGER NOT NULL,
+                    end INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS coverage_sensor ON coverage (sensor_index, kind, start);
+            """)
+        if not has_coverage:
+            self._backfill_coverage()
+        
+        # Logs written before the row counts were kept
+        if "rows" not in [column[1] for column in self.conn.execute("PRAGMA table_info(sensors)")]:
+            with self.conn:
+                self.conn.execute("ALTER TABLE sensors ADD COLUMN rows INTEGER NOT NULL DEFAULT 0")
+                self.conn.execute("ALTER TABLE sensors ADD COLUMN row_seconds INTEGER NOT NULL DEFAULT 0")
+
+    def close(self):
+        self.conn.close()
+
+    def _backfill_coverage(self):
+        # Build the coverage index of a log written before it existed: [min_date, max_date] is
+        # downloaded data and every no_data window is a confirmed empty range
+        with self.lock:
+            dates = self.conn.execute("SELECT sensor_index, min_date, max_date FROM sensors "
+                                      "WHERE min_date IS NOT NULL AND max_date IS NOT NULL").fetchall()
+            windows = self.conn.execute("SELECT sensor_index, window FROM no_data").fetchall()
+        for sensor, min_date, max_date in dates:
+            start = _iso_to_epoch(datetime.strptime(min_date, "%Y_%m_%d").strftime('%Y-%m-%dT%H:%M:%SZ'))
+            end = _iso_to_epoch(datetime.strptime(max_date, "%Y_%m_%d").strftime('%Y-%m-%dT%H:%M:%SZ')) + 86400
+            self.add_coverage(sensor, "data", start, end)
+        for sensor, window in windows:
+            start, end = window.split(" to ")
+            self.add_coverage(sensor, "no_data", start, end)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write(self, sql, params=()):
+        # One transaction per update
+        with self.lock, self.conn:
+            self.conn.execute(sql, params)
+
+    def _read(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def get_meta(self, key, default=None):
+        rows = self._read("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0][0] if rows else default
+
+    def set_meta(self, key, value):
+        self._write("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def add_sensors(self, sensor_list):
+        """Add sensors that are not in the log yet."""
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO sensors (sensor_index) VALUES (?)",
+                                  [(int(sensor),) for sensor in sensor_list])
+
+    def set_dates(self, sensor, min_date, max_date):
+        self._write("""INSERT INTO sensors (sensor_index, min_date, max_date) VALUES (?, ?, ?)
+                       ON CONFLICT (sensor_index) DO UPDATE SET min_date = excluded.min_date, max_date = excluded.max_date""",
+                    (int(sensor), min_date, max_date))
+
+    def extend_dates(self, sensor, min_date, max_date):
+        """Widen the downloaded date range of a sensor to include [min_date, max_date]."""
+        self._write("""INSERT INTO sensors (sensor_index, min_date, max_date) VALUES (?, ?, ?)
+                       ON CONFLICT (sensor_index) DO UPDATE SET
+                       min_date = MIN(COALESCE(min_date, excluded.min_date), excluded.min_date),
+                       max_date = MAX(COALESCE(max_date, excluded.max_date), excluded.max_date)""",
+                    (int(sensor), min_date, max_date))
+
+    def add_rows(self, sensor, n_rows, seconds):
+        """Add a downloaded window of `seconds` length with n_rows rows to the row counts of a sensor."""
+        self._write("""INSERT INTO sensors (sensor_index, rows, row_seconds) VALUES (?, ?, ?)
+                       ON CONFLICT (sensor_index) DO UPDATE SET
+                       rows = rows + excluded.rows, row_seconds = row_seconds + excluded.row_seconds""",
+                    (int(sensor), int(n_rows), int(seconds)))
+
+    def densities(self, average_time):
+        """
+        Observed data density per sensor: rows downloaded / rows possible over the downloaded windows,
+        between 0.05 and 1. Sensors without row counts are left out.
+        """
+        rows = self._read("SELECT sensor_index, rows, row_seconds FROM sensors WHERE rows > 0 AND row_seconds > 0")
+        rows_per_second = _rows_per_day(average_time) / 86400
+        return {sensor: min(1.0, max(0.05, n_rows / (seconds * rows_per_second))) for sensor, n_rows, seconds in rows}
+
+    def add_coverage(self, sensor, kind, start, end):
+        """
+        Record that [start, end) of a sensor is covered.
+
+        kind is "data" (downloaded), "no_data" (the API confirmed there is nothing) or "failed"
+        (a permanent error, e.g. an unknown sensor; see clear_failed). start and end are epoch seconds or ISO strings. Overlapping and
+        touching intervals of the same kind are merged, so each sensor keeps a short sorted list.
+        """
+        start = _iso_to_epoch(start) if isinstance(start, str) else int(start)
+        end = _iso_to_epoch(end) if isinstance(end, str) else int(end)
+        with self.lock, self.conn:
+            rows = self.conn.execute("""SELECT rowid, start, end FROM coverage
+                                        WHERE sensor_index = ? AND kind = ? AND start <= ? AND end >= ?""",
+                                     (int(sensor), kind, end, start)).fetchall()
+            if rows:
+                start = min([start] + [row[1] for row in rows])
+                end = max([end] + [row[2] for row in rows])
+                self.conn.executemany("DELETE FROM coverage WHERE rowid = ?", [(row[0],) for row in rows])
+            self.conn.execute("INSERT INTO coverage (sensor_index, kind, start, end) VALUES (?, ?, ?, ?)",
+                              (int(sensor), kind, start, end))
+
+    def coverage(self, sensors=None, kinds=("data", "no_data", "failed")):
+        """
+        Merged coverage intervals per sensor, read in one query.
+
+        Returns {sensor_index: [(start, end), ...]} with sorted, non-overlapping epoch-second intervals.
+        """
+        placeholders = ",".join("?" * len(kinds))
+        rows = self._read(f"SELECT sensor_index, start, end FROM coverage WHERE kind IN ({placeholders}) "
+                          "ORDER BY sensor_index, start", tuple(kinds))
+        wanted = None if sensors is None else set(int(sensor) for sensor in sensors)
+        intervals = {}
+        for sensor, start, end in rows:
+            if wanted is None or sensor in wanted:
+                intervals.setdefault(sensor, []).append((start, end))
+        return {sensor: merge_intervals(sensor_intervals) for sensor, sensor_intervals in intervals.items()}
+
+    def clear_failed(self, sensors=None):
+        """
+        Remove the "failed" coverage of the given sensors (default: all sensors), so their windows are
+        planned again. Returns the number of intervals removed.
+        """
+        with self.lock, self.conn:
+            if sensors is None:
+                return self.conn.execute("DELETE FROM coverage WHERE kind = 'failed'").rowcount
+            return self.conn.execute("DELETE FROM coverage WHERE kind = 'failed' AND sensor_index IN "
+                                     f"({','.join('?' * len(sensors))})", [int(sensor) for sensor in sensors]).rowcount
+
+    def add_url_issue(self, sensor, message):
+        self._write("INSERT INTO url_issue (sensor_index, message) VALUES (?, ?)", (int(sensor), message))
+
+    def add_no_data(self, sensor, window):
+        """Record an empty window ("{start} to {end}") and add it to the coverage index."""
+        self._write("INSERT OR IGNORE INTO no_data (sensor_index, window) VALUES (?, ?)", (int(sensor), window))
+        start, end = window.split(" to ")
+        self.add_coverage(sensor, "no_data", start, end)
+
+    def mark_skipped(self, sensor):
+        self._write("""INSERT INTO sensors (sensor_index, skipped) VALUES (?, 1)
+                       ON CONFLICT (sensor_index) DO UPDATE SET skipped = 1""", (int(sensor),))
+
+    def mark_skipped_many(self, sensors):
+        with self.lock, self.conn:
+            self.conn.executemany("""INSERT INTO sensors (sensor_index, skipped) VALUES (?, 1)
+                                     ON CONFLICT (sensor_index) DO UPDATE SET skipped = 1""",
+                                  [(int(sensor),) for sensor in sensors])
 
-    # Check if the log file exists, and load existing data if available
-    if os.path.exists(log_file_path):
-        with open(log_file_path, 'r') as log_file:
+    def clear_skipped(self):
+        self._write("UPDATE sensors SET skipped = 0 WHERE skipped = 1")
+
+    def skipped_sensors(self):
+        return [row[0] for row in self._read("SELECT sensor_index FROM sensors WHERE skipped = 1 ORDER BY sensor_index")]
+
+    def summary(self):
+        """Counts of the log: sensors, rows, coverage by kind and issues."""
+        sensors, skipped, with_data, rows = self._read(
+            "SELECT COUNT(*), SUM(skipped), SUM(min_date IS NOT NULL), SUM(rows) FROM sensors")[0]
+        coverage = {kind: {"windows": windows, "sensor_days": round(seconds / 86400, 1)}
+                    for kind, windows, seconds in self._read(
+                        "SELECT kind, COUNT(*), SUM(end - start) FROM coverage GROUP BY kind ORDER BY kind")}
+        return {
+            "sensors": sensors,
+            "sensors_with_data": with_data or 0,
+            "sensors_skipped": skipped or 0,
+            "rows": rows or 0,
+            "coverage": coverage,
+            "url_issues": self._read("SELECT COUNT(*) FROM url_issue")[0][0],
+            "no_data_windows": self._read("SELECT COUNT(*) FROM no_data")[0][0],
+            "sensors_index_time_stamp": self.get_meta("sensors_index.csv time_stamp"),
+            "shard_status": self.get_meta("shard_status")
+        }
+
+    def get_sensor(self, sensor):
+        """Return the log entry of one sensor in the sensor_log.json layout, or None."""
+        rows = self._read("SELECT min_date, max_date FROM sensors WHERE sensor_index = ?", (int(sensor),))
+        if not rows:
+            return None
+        return {
+            "min_date": rows[0][0],
+            "max_date": rows[0][1],
+            "url_issue": [row[0] for row in self._read("SELECT message FROM url_issue WHERE sensor_index = ? ORDER BY rowid", (int(sensor),))],
+            "no_data": [row[0] for row in self._read("SELECT window FROM no_data WHERE sensor_index = ? ORDER BY rowid", (int(sensor),))]
+        }
+
+    def to_dict(self):
+        """Export the whole log in the sensor_log.json layout."""
+        log_data = {
+            "sensors_index.csv file last updated": self.get_meta("sensors_index.csv file last updated"),
+            "sensors_skipped": self.skipped_sensors()
+        }
+        for sensor, min_date, max_date in self._read("SELECT sensor_index, min_date, max_date FROM sensors ORDER BY sensor_index"):
+            log_data[str(sensor)] = {"min_date": min_date, "max_date": max_date, "url_issue": [], "no_data": []}
+        for sensor, message in self._read("SELECT sensor_index, message FROM url_issue ORDER BY rowid"):
+            log_data[str(sensor)]["url_issue"].append(message)
+        for sensor, window in self._read("SELECT sensor_index, window FROM no_data ORDER BY rowid"):
+            log_data[str(sensor)]["no_data"].append(window)
+        return log_data
+
+    def copy_sensors_from(self, other_path, sensors=None):
+        """
+        Replace the entries of some sensors (default: all sensors of the other log) with the ones in another log.
+
+        Used to seed a shard log from the global log and to merge shard logs back into it.
+        """
+        with self.lock:
+            self.conn.execute("ATTACH DATABASE ? AS other", (other_path,))
+            try:
+                with self.conn:
+                    self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS copied (sensor_index INTEGER PRIMARY KEY)")
+                    self.conn.execute("DELETE FROM copied")
+                    if sensors is None:
+                        self.conn.execute("INSERT INTO copied SELECT sensor_index FROM other.sensors")
+                    else:
+                        self.conn.executemany("INSERT OR IGNORE INTO copied VALUES (?)", [(int(sensor),) for sensor in sensors])
+                    for table in ["sensors", "url_issue", "no_data", "coverage"]:
+                        columns = ", ".join(column[1] for column in self.conn.execute(f"PRAGMA main.table_info({table})"))
+                        self.conn.execute(f"DELETE FROM main.{table} WHERE sensor_index IN (SELECT sensor_index FROM copied)")
+                        self.conn.execute(f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM other.{table} "
+                                          "WHERE sensor_index IN (SELECT sensor_index FROM copied)")
+            finally:
+                self.conn.execute("DETACH DATABASE other")
+
+    def import_json(self, json_path=LEGACY_LOG_FILE_PATH):
+        """Import a sensor_log.json file into the log in one transaction."""
+        with open(json_path, 'r') as log_file:
             log_data = json.load(log_file)
 
-    # Update the log with the last download date
-    log_data["sensors_index.csv file last updated"] = str(last_download_date)
-    log_data["sensors_skipped"] = []
+        sensors, url_issues, no_data = [], [], []
+        for key, entry in log_data.items():
+            if not key.isdigit() or not isinstance(entry, dict):
+                continue
+            sensors.append((int(key), entry.get("min_date"), entry.get("max_date")))
+            url_issues += [(int(key), message) for message in entry.get("url_issue", [])]
+            no_data += [(int(key), window) for window in entry.get("no_data", [])]
+        skipped = [(int(sensor),) for sensor in log_data.get("sensors_skipped", [])]
+
+        with self.lock, self.conn:
+            self.conn.executemany("""INSERT INTO sensors (sensor_index, min_date, max_date) VALUES (?, ?, ?)
+                                     ON CONFLICT (sensor_index) DO UPDATE SET
+                                     min_date = COALESCE(excluded.min_date, min_date),
+                                     max_date = COALESCE(excluded.max_date, max_date)""", sensors)
+            self.conn.executemany("INSERT INTO url_issue (sensor_index, message) VALUES (?, ?)", url_issues)
+            self.conn.executemany("INSERT OR IGNORE INTO no_data (sensor_index, window) VALUES (?, ?)", no_data)
+            self.conn.executemany("""INSERT INTO sensors (sensor_index, skipped) VALUES (?, 1)
+                                     ON CONFLICT (sensor_index) DO UPDATE SET skipped = 1""", skipped)
+            if log_data.get("sensors_index.csv file last updated"):
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                  ("sensors_index.csv file last updated", str(log_data["sensors_index.csv file last updated"])))
+
+        self._backfill_coverage()
 
-    # Add or update each sensor in the log
-    for sensor in sensor_list:
-        if str(sensor) not in log_data:
-            log_data[str(sensor)] = {
-                "min_date": None,
-                "max_date": None,
-                "url_issue": [],
-                "no_data": []
-            }
+        print(f"{len(sensors)} sensors imported from {json_path} into {self.db_path}")
+
+def open_sensor_log(log_file_path=LOG_FILE_PATH, legacy_log_file_path=LEGACY_LOG_FILE_PATH, read_only=False):
+    """Open the download log, importing the old sensor_log.json the first time (into memory only with read_only)."""
     
-    # Write the updated log to a JSON file
-    with open(log_file_path, 'w') as log_file:
-        json.dump(log_data, log_file, indent=4)
+    is_new = not os.path.exists(log_file_path)
+    sensor_log = SensorLog(log_file_path, read_only=read_only)
+    if is_new and legacy_log_file_path and os.path.exists(legacy_log_file_path):
+        sensor_log.import_json(legacy_log_file_path)
+    return sensor_log
+
+# Function to update the log file with the last download date and sensor info
+def update_sensor_index_log(log_file_path, sensor_list, last_download_date, api_time_stamp=None):
+    with open_sensor_log(log_file_path) as sensor_log:
+        # Update the log with the last download date
+        sensor_log.set_meta("sensors_index.csv file last updated", last_download_date)
+        sensor_log.clear_skipped()
+        
+        # API time stamp of the sensor list: the next delta refresh asks for sensors modified since then
+        if api_time_stamp is not None:
+            sensor_log.set_meta("sensors_index.csv time_stamp", api_time_stamp)
+
+        # Add each new sensor to the log
+        sensor_log.add_sensors(sensor_list)
     
     print(f"{log_file_path} successfully updated.")
     
-# Function to get sensors from the API
-def get_sensors(key_read, filename = "sensors_index",  download_dir = "processed"):
-    
-    '''
-    Parameters:
+# Cached HTTP responses of the PurpleAir API
+HTTP_CACHE_DIR = 'processed/cache/http'
 
-    key_read (string): The API key required to access the PurpleAir API.
-    filename (string, optional): The name of the output CSV file (default: "sensors_index").
+class CacheMissError(requests.exceptions.RequestException):
+    """Raised in replay-only mode for a request that is not in the cache."""
+
+class CachedResponse:
+    """Response served from the cache, with the parts of requests.Response used by this module."""
+
+    status_code = 200
+    from_cache = True
+
+    def __init__(self, url, content):
+        self.url = url
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode()
+
+    def raise_for_status(self):
+        pass
+
+class PurpleAirTransport:
+    """
+    HTTP transport used by get_sensors and get_historicaldata.
+
+    Requests go through one pooled keep-alive session that retries connection errors, 429 and 5xx
+    responses with exponential backoff. Successful response bodies are cached on disk, gzip-compressed,
+    under the SHA-256 of the request URL without the api_key, so a re-run does not pay again for
+    windows it already received. The cache is bounded by max_cache_bytes and evicts the least
+    recently used entries. With replay_only, the network is never used and a miss raises CacheMissError.
+    """
+
+    def __init__(self, cache_dir=HTTP_CACHE_DIR, max_cache_bytes=2 * 1024 ** 3, replay_only=False,
+                 retries=3, backoff_factor=1, pool_size=10, timeout=60):
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.replay_only = replay_only
+        self.timeout = timeout
+        self.lock = threading.Lock()
+
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=["GET"], respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.cache_bytes = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.cache_bytes = sum(os.path.getsize(path) for path in self._cache_files())
+
+    @staticmethod
+    def cache_key(url):
+        """SHA-256 of the URL with the api_key parameter removed."""
+        parts = urlsplit(url)
+        query = urlencode([(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                           if key != "api_key"])
+        return hashlib.sha256(urlunsplit(parts._replace(query=query)).encode()).hexdigest()
+
+    def _cache_path(self, url):
+        key = self.cache_key(url)
+        return os.path.join(self.cache_dir, key[:2], key + ".gz")
+
+    def _cache_files(self):
+        for folder, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".gz"):
+                    yield os.path.join(folder, name)
+
+    def _read_cache(self, url, max_age):
+        path = self._cache_path(url)
+        try:
+            stat = os.stat(path)
+            if max_age is not None and not self.replay_only and time.time() - stat.st_mtime > max_age:
+                return None
+            with open(path, "rb") as cache_file:
+                content = gzip.decompress(cache_file.read())
+            # The access time orders the LRU eviction, the modification time is when the entry was stored
+            os.utime(path, (time.time(), stat.st_mtime))
+            return CachedResponse(url, content)
+        except (FileNotFoundError, OSError, EOFError):
+            return None
+
+    def _write_cache(self, url, content):
+        path = self._cache_path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "wb") as cache_file:
+            cache_file.write(gzip.compress(content, compresslevel=6))
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.cache_bytes += size
+            if self.cache_bytes > self.max_cache_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Remove the least recently used entries until the cache is at 90% of its limit
+        entries = []
+        for path in self._cache_files():
+            try:
+                stat = os.stat(path)
+                entries.append((stat.st_atime, stat.st_size, path))
+            except FileNotFoundError:
+                continue
+        self.cache_bytes = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if self.cache_bytes <= 0.9 * self.max_cache_bytes:
+                break
+            try:
+                os.remove(path)
+                self.cache_bytes -= size
+            except FileNotFoundError:
+                pass
+
+    def cached(self, url, max_age=None):
+        """The cached response for a URL, or None."""
+        return self._read_cache(url, max_age) if self.cache_dir else None
+
+    def get(self, url, cache=True, max_age=None):
+        """
+        GET a URL, from the cache when possible.
+
+        cache (bool): Read and write the cache for this request.
+        max_age (int, optional): Outside replay mode, ignore cached entries older than max_age seconds.
+        """
+        if cache:
+            cached = self.cached(url, max_age)
+            if cached is not None:
+                return cached
+        if self.replay_only:
+            raise CacheMissError(f"Not in the cache (replay-only mode): {self.cache_key(url)}")
+
+        response = self.session.get(url, timeout=self.timeout)
+        response.from_cache = False
+        if cache and self.cache_dir and response.status_code == 200:
+            self._write_cache(url, response.content)
+        return response
+
+_default_transport = None
+
+def get_transport():
+    """The transport used when none is passed: a PurpleAirTransport with the default cache."""
+    global _default_transport
+    if _default_transport is None:
+        _default_transport = PurpleAirTransport()
+    return _default_transport
+
+def set_transport(transport):
+    """Replace the default transport, e.g. with PurpleAirTransport(replay_only=True)."""
+    global _default_transport
+    _default_transport = transport
+
+# Default JSON-lines trace and Prometheus textfile of a run
+TRACE_PATH = 'logs/purple_air_trace.jsonl'
+METRICS_PATH = 'logs/purple_air.prom'
+
+# Query parameters holding the API key, redacted from everything printed or logged
+_API_KEY_PATTERN = re.compile(r'(api_key=)[^&\s]+')
+
+def redact(text):
+    """Replace the API key in a URL or an error message with ***."""
+    return _API_KEY_PATTERN.sub(r'\1***', str(text))
+
+class Instrumentation:
+    """
+    Structured events and metrics of get_sensors, get_historicaldata and LiveIngest.
+
+    Every request and planned window produces one event (a dictionary with a "kind": "sensors",
+    "window", "merge", "run", or "live", "live_flush" and "live_cycle" for LiveIngest). Window events
+    carry the sensor, the window, the HTTP status, the latency, bytes, rows, parse and write seconds,
+    the outcome and the skip reason; merge events carry the compaction seconds of a partition. Events
+    are appended to a JSON-lines trace when trace_path is given, and aggregated into counters and
+    stage-time histograms that write_metrics exports in the Prometheus text format (for the
+    node_exporter textfile collector), along with the gauges and histograms set by set_gauge and observe.
+
+    With profile_dir, each stage (network, parse, write, merge) also runs under cProfile, and
+    close() dumps one pstats file per stage, e.g. `python -m pstats logs/profile/parse.prof`.
+    """
+
+    # Histogram buckets of the stage times, in seconds
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    # Event field -> stage of the histogram
+    STAGE_FIELDS = {"latency_seconds": "network", "parse_seconds": "parse",
+                    "write_seconds": "write", "merge_seconds": "merge"}
+
+    def __init__(self, trace_path=None, metrics_path=None, profile_dir=None, labels=None):
+        self.trace_path = trace_path
+        self.metrics_path = metrics_path
+        self.profile_dir = profile_dir
+        self.labels = dict(labels or {})    # constant labels of every metric, e.g. {"shard": "3"}
+        self.lock = threading.Lock()
+        self.counters = {}                  # (name, labels) -> value
+        self.histograms = {}                # (name, labels) -> [bounds, bucket counts, sum, count]
+        self.gauges = {}                    # (name, labels) -> value
+        self.profilers = {}                 # (stage, thread id) -> cProfile.Profile
+
+        self.trace_file = None
+        if trace_path:
+            os.makedirs(os.path.dirname(trace_path) or ".", exist_ok=True)
+            self.trace_file = open(trace_path, "a", buffering=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def _observe(self, name, values, buckets=None, **labels):
+        bounds = buckets or self.BUCKETS
+        histogram = self.histograms.setdefault((name, tuple(labels.items())), [bounds, [0] * len(bounds), 0.0, 0])
+        for value in values:
+            index = bisect.bisect_left(bounds, value)
+            if index < len(bounds):
+                histogram[1][index] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    def observe(self, name, values, buckets=None, **labels):
+        """Add values (e.g. the data lag of every new row) to the histogram `name` with the given bucket bounds."""
+        with self.lock:
+            self._observe(name, [float(value) for value in values], buckets, **labels)
+
+    def set_gauge(self, name, value, **labels):
+        """Set the gauge `name`, e.g. the duration of the last polling cycle."""
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def event(self, kind, **fields):
+        """Record one event. Fields with a None value are left out of the trace."""
+        record = {"time": round(time.time(), 3), "kind": kind}
+        record.update({key: value for key, value in fields.items() if value is not None})
+        with self.lock:
+            if self.trace_file is not None:
+                self.trace_file.write(json.dumps(record) + "\n")
+            
+            outcome = record.get("outcome", "ok")
+            self._count("purpleair_events_total", kind=kind, outcome=outcome)
+            if "status" in record:
+                self._count("purpleair_http_responses_total", kind=kind, status=str(record["status"]))
+            if "skip_reason" in record:
+                self._count("purpleair_skipped_windows_total", reason=record["skip_reason"])
+            for field in ["bytes", "rows"]:
+                if field in record:
+                    self._count(f"purpleair_{field}_total", record[field], kind=kind)
+            for field, stage in self.STAGE_FIELDS.items():
+                if field in record:
+                    self._observe("purpleair_stage_seconds", [record[field]], stage=stage)
+
+    @contextmanager
+    def profile(self, stage):
+        """Run the block under the cProfile profiler of the stage (a no-op without profile_dir)."""
+        if not self.profile_dir:
+            yield
+            return
+        # One profiler per stage and thread: a profiler only sees the thread that enabled it
+        key = (stage, threading.get_ident())
+        with self.lock:
+            profiler = self.profilers.setdefault(key, cProfile.Profile())
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is active (Python 3.12+ allows one at a time): run unprofiled
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+
+    def metrics_text(self):
+        """The counters, gauges and histograms in the Prometheus text exposition format."""
+        def format_labels(labels):
+            labels = dict(self.labels, **dict(labels))
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+        
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+            
+            for name in sorted({name for name, _ in self.gauges}):
+                lines.append(f"# TYPE {name} gauge")
+                for (gauge, labels), value in sorted(self.gauges.items()):
+                    if gauge == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+            
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (histogram, labels), (bounds, buckets, total, count) in sorted(self.histograms.items()):
+                    if histogram != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket in zip(bounds, buckets):
+                        cumulative += bucket
+                        lines.append(f"{name}_bucket{format_labels(list(labels) + [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_bucket{format_labels(list(labels) + [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {round(total, 6)}")
+                    lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self, metrics_path=None):
+        """Write the metrics file atomically, so the textfile collector never reads a partial file."""
+        metrics_path = metrics_path or self.metrics_path
+        if not metrics_path:
+            return
+        os.makedirs(os.path.dirname(metrics_path) or ".", exist_ok=True)
+        tmp_path = f"{metrics_path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "w") as metrics_file:
+            metrics_file.write(self.metrics_text())
+        os.replace(tmp_path, metrics_path)
+
+    def write_profiles(self):
+        """Dump one pstats file per stage, merged over the threads that ran it."""
+        if not self.profile_dir or not self.profilers:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        with self.lock:
+            by_stage = {}
+            for (stage, _), profiler in self.profilers.items():
+                by_stage.setdefault(stage, []).append(profiler)
+        for stage, profilers in by_stage.items():
+            profiles = [profiler for profiler in profilers if profiler.getstats()]
+            if profiles:
+                stats = pstats.Stats(*profiles)
+                stats.dump_stats(os.path.join(self.profile_dir, f"{stage}.prof"))
+
+    def flush(self):
+        """Write the metrics file and the stage profiles of everything recorded so far."""
+        self.write_metrics()
+        self.write_profiles()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.trace_file is not None:
+                self.trace_file.close()
+                self.trace_file = None
+
+# U.S. boundaries used to flag sensors located in the U.S.
+US_BOUNDARY_PATH = "data/us_shp.json"
+
+class USBoundary:
+    """
+    U.S. boundary prepared for fast point-in-polygon tests.
+
+    shapely and geopandas are imported on first use, so history-only runs never load the geometry stack.
+
+    The boundary is split into its polygons and indexed with an STRtree. The reprojected polygons
+    are cached as WKB in a Parquet file, so the GeoJSON is read and reprojected only when it changes.
+    """
+
+    def __init__(self, polygons):
+        import shapely
+        shapely.prepare(polygons)
+        self.polygons = polygons
+        self.tree = shapely.STRtree(polygons)
+
+    @classmethod
+    def load(cls, boundary_path=US_BOUNDARY_PATH, cache_dir="processed/cache"):
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        import shapely
+        cache_file = os.path.join(cache_dir, "us_boundary.parquet")
+        if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(boundary_path):
+            wkb = pq.read_table(cache_file).column("wkb").to_numpy(zero_copy_only=False)
+            return cls(shapely.from_wkb(wkb))
+
+        # Load U.S. boundaries from a GeoJSON file, in the CRS of the sensor coordinates
+        import geopandas as gpd
+        us_shp = gpd.read_file(boundary_path).to_crs(4326)
+        polygons = np.asarray(us_shp.geometry.explode(index_parts=False).array)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        pq.write_table(pa.table({"wkb": shapely.to_wkb(polygons)}), cache_file)
+        return cls(polygons)
+
+    def contains(self, longitude, latitude):
+        """Boolean array: True for the points that intersect the boundary."""
+        import numpy as np
+        import shapely
+        points = shapely.points(np.asarray(longitude, dtype=float), np.asarray(latitude, dtype=float))
+        inside = np.zeros(len(points), dtype=bool)
+        
+        # Candidate (point, polygon) pairs from the bounding boxes, then the exact test on the prepared polygons
+        point_index, polygon_index = self.tree.query(points)
+        hit = shapely.intersects(self.polygons[polygon_index], points[point_index])
+        inside[point_index[hit]] = True
+        return inside
+
+def classify_us(df, previous_index_path=None, cache_dir="processed/cache"):
+    """
+    Return the 'us' flag (1 if a sensor is in the U.S.; otherwise 0) for every row of df.
+
+    Sensors whose sensor_index, latitude and longitude are unchanged in the previous sensor index
+    keep their flag; only new or moved sensors get a point-in-polygon test, and the boundary is
+    loaded only if there are any.
+    """
+    import pandas as pd
+    import numpy as np
     
-    Returns:
+    us = np.full(len(df), np.nan)
     
-    The GeoDataFrame containing the sensor data along with the us flag
+    if previous_index_path and os.path.exists(previous_index_path):
+        previous = pd.read_csv(previous_index_path, usecols=['sensor_index', 'latitude', 'longitude', 'us'])
+        previous = previous.drop_duplicates(subset='sensor_index')
+        merged = df[['sensor_index', 'latitude', 'longitude']].merge(previous, on='sensor_index', how='left',
+                                                                     suffixes=('', '_previous'))
+        unchanged = ((merged['latitude'] == merged['latitude_previous']) &
+                     (merged['longitude'] == merged['longitude_previous']) &
+                     merged['us'].notna()).to_numpy()
+        us[unchanged] = merged['us'].to_numpy()[unchanged]
     
-    Detailed Steps:
+    todo = np.isnan(us)
+    if todo.any():
+        boundary = USBoundary.load(cache_dir=cache_dir)
+        us[todo] = boundary.contains(df['longitude'].to_numpy()[todo], df['latitude'].to_numpy()[todo])
+    
+    print(f"{int(todo.sum())} new or moved sensors classified, {int((~todo).sum())} sensors unchanged")
+    return us.astype(int)
 
-    1. Define API URL: The function builds a URL to request sensor data from the PurpleAir API, specifying fields like name, location_type, latitude, longitude, and other sensor metadata.
-    2. API Call: The function sends a GET request to the API using the constructed URL. If the request is successful (status_code = 200), it loads the JSON response and converts it into a pandas DataFrame. If the request fails, it raises an exception with an error description.
-    3. Data Cleaning: Converts UNIX timestamps (last_modified, date_created, last_seen) into a human-readable date format.
-    4. Check U.S. Sensors: 
-            a. Converts the sensor data into a GeoDataFrame using the latitude and longitude of the sensors.
-            b. Loads a GeoJSON file containing U.S. boundaries.
-            c. Ensures both datasets share the same coordinate reference system (CRS).
-            d. Performs a spatial join to flag sensors that are located in the U.S. (us = 1 if in the U.S., us = 0 otherwise).
-    5. Saving Data:
-            a. Cleans up unnecessary columns from the GeoDataFrame.
-            b. Ensures the target directory for saving the file exists.
-            c. Saves the cleaned sensor data as a CSV file.
-    6. Logging:
-            a. Extracts the list of sensor indices.
-            b. Updates a log file (sensor_log.json) with the sensor list and the current date.
-    '''
+# Sensor fields stored in the sensor index
+SENSOR_FIELDS = ['name', 'location_type', 'latitude', 'longitude', 'altitude', 
+                 'position_rating', 'uptime', 'last_seen', 'last_modified', 'date_created']
+
+def _fetch_sensors(key_read, fields_list, extra_api_url='', transport=None, instrumentation=None):
+    """Request the sensor list from the API. Returns the DataFrame and the API time stamp of the response."""
+    import pandas as pd
     
     # PurpleAir API URL
-    root_url = 'https://api.purpleair.com/v1/sensors/'
-    
-    # fields to get
-    fields_list = ['name', 'location_type', 'latitude', 'longitude', 'altitude', 
-                   'position_rating', 'uptime', 'last_seen', 'last_modified', 'date_created']
+    root_url = API_ROOT_URL
     
     # Build the fields parameter for the API call
     fields_api_url = '&fields=' + '%2C'.join(fields_list)
     
     # Final API URL
-    api_url = root_url + f'?api_key={key_read}' + fields_api_url
+    api_url = root_url + f'?api_key={key_read}' + fields_api_url + extra_api_url
     
-    print(api_url)
+    # Getting data: the sensor list changes, so the cache is only read in replay-only mode
+    request_start = time.perf_counter()
+    response = (transport or get_transport()).get(api_url, max_age=0)
+    latency = time.perf_counter() - request_start
     
-    # Getting data
-    response = requests.get(api_url)
     if response.status_code == 200:
+        parse_start = time.perf_counter()
         json_data = json.loads(response.content)
-        df = pd.DataFrame.from_records(json_data["data"])
-        df.columns = json_data["fields"]
+        df = pd.DataFrame.from_records(json_data["data"], columns=json_data["fields"])
+        if instrumentation is not None:
+            instrumentation.event("sensors", url=redact(api_url), status=200, outcome="data",
+                                  latency_seconds=round(latency, 6), bytes=len(response.content), rows=len(df),
+                                  parse_seconds=round(time.perf_counter() - parse_start, 6))
     else:
+        if instrumentation is not None:
+            instrumentation.event("sensors", url=redact(api_url), status=response.status_code, outcome="http_error",
+                                  latency_seconds=round(latency, 6), bytes=len(response.content))
         json_data = json.loads(response.content)
         print("Error description:", json_data["description"])
         raise requests.exceptions.RequestException("Failed to fetch sensor data.")
     
+    return df, json_data.get("time_stamp")
+
+def _prepare_sensors(df, previous_index_path, cache_dir):
+    """Clean the sensor list and add the geometry and the 'us' flag."""
+    import pandas as pd
+    
+    # The geometry stack is imported only by the commands that build the sensor index
+    import geopandas as gpd
+    
     # ----------------------- clean sensor index df
     # Convert UNIX timestamps to readable date format
     df['last_modified'] = pd.to_datetime(df['last_modified'], unit='s')
@@ -103,28 +866,59 @@ def get_sensors(key_read, filename = "sensors_index",  download_dir = "processed
     
     # ----------------------- create new column 'us': us = 1 if a sensor is in US; otherwise = 0
     # Create a GeoDataFrame
-    gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.longitude, df.latitude), crs=4326)
+    gdf_sensors = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.longitude, df.latitude), crs=4326)
 
-    # Load U.S. boundaries from a GeoJSON file
-    us_shp = gpd.read_file("data/us_shp.json")
-
-    # Ensure the CRS matches
-    us_shp.to_crs(gdf.crs, inplace=True)
+    # Reuse the flag of sensors that did not move since the last sensor index; test only new or moved ones
+    gdf_sensors['us'] = classify_us(gdf_sensors, previous_index_path=previous_index_path, cache_dir=cache_dir)
+    
+    return gdf_sensors
 
-    # Perform a spatial join to check if the points are in the U.S.
-    gdf_us = gpd.sjoin(gdf, us_shp, how="left", predicate="intersects")
+# Function to get sensors from the API
+def get_sensors(key_read, filename = "sensors_index",  download_dir = "processed", transport = None, instrumentation = None,
+                log_file_path = LOG_FILE_PATH):
+    
+    '''
+    Parameters:
 
-    # Add 'us' flag: if the point is in the U.S.
-    gdf_us['us'] = gdf_us['index_right'].notnull().astype(int)
+    key_read (string): The API key required to access the PurpleAir API.
+    filename (string, optional): The name of the output CSV file (default: "sensors_index").
+    transport (PurpleAirTransport, optional): HTTP transport with the response cache (default: get_transport()).
+    instrumentation (Instrumentation, optional): Receives a "sensors" event for the request (status, latency, bytes, rows).
+    log_file_path (string, optional): The download log that records the sensor list and the API time stamp (default: "sensor_log.sqlite").
+    
+    Returns:
+    
+    The GeoDataFrame containing the sensor data along with the us flag
+    
+    Detailed Steps:
 
-    # Drop unnecessary columns
-    gdf_sensors = gdf_us.drop(columns=['index_right', 'AFFGEOID', 'GEOID', 'NAME'])
+    1. Define API URL: The function builds a URL to request sensor data from the PurpleAir API, specifying fields like name, location_type, latitude, longitude, and other sensor metadata.
+    2. API Call: The function sends a GET request to the API using the constructed URL. If the request is successful (status_code = 200), it loads the JSON response and converts it into a pandas DataFrame. If the request fails, it raises an exception with an error description.
+    3. Data Cleaning: Converts UNIX timestamps (last_modified, date_created, last_seen) into a human-readable date format.
+    4. Check U.S. Sensors: 
+            a. Converts the sensor data into a GeoDataFrame using the latitude and longitude of the sensors.
+            b. Loads a GeoJSON file containing U.S. boundaries.
+            c. Ensures both datasets share the same coordinate reference system (CRS). The reprojected boundary is cached in processed/cache/us_boundary.parquet with a spatial index.
+            d. Flags sensors that are located in the U.S. (us = 1 if in the U.S., us = 0 otherwise). Sensors with the same sensor_index, latitude and longitude as in the existing sensors_index.csv keep their flag; only new or moved sensors are tested.
+    5. Saving Data:
+            a. Cleans up unnecessary columns from the GeoDataFrame.
+            b. Ensures the target directory for saving the file exists.
+            c. Saves the cleaned sensor data as a CSV file.
+    6. Logging:
+            a. Extracts the list of sensor indices.
+            b. Updates the log file (log_file_path) with the sensor list, the current date and the API time stamp used by refresh_sensors.
+    '''
+    
+    # Getting data
+    df, api_time_stamp = _fetch_sensors(key_read, SENSOR_FIELDS, transport=transport, instrumentation=instrumentation)
+    
+    out_dir = os.path.join(download_dir, filename + ".csv")
+    gdf_sensors = _prepare_sensors(df, previous_index_path=out_dir, cache_dir=os.path.join(download_dir, "cache"))
+    gdf_sensors['removed'] = 0
 
     # Directory to store the file
     os.makedirs(download_dir, exist_ok=True)  # Create directory if it doesn't exist
     
-    out_dir = os.path.join(download_dir, filename + ".csv")
-    
     print(out_dir)
     # Define file path and save the CSV file
     gdf_sensors.to_csv(out_dir, index=False, header=True)
@@ -137,45 +931,279 @@ def get_sensors(key_read, filename = "sensors_index",  download_dir = "processed
     # Update the download log
     today = datetime.now().date()
 
-    log_file_path = 'sensor_log.json'
-    update_sensor_index_log(log_file_path, sensor_list, today)
+    update_sensor_index_log(log_file_path, sensor_list, today, api_time_stamp)
     
     return gdf_sensors
 
-def get_sensorslist(key_read, filename = "sensors_index", download_dir = "processed"):
-    """Retrieve sensor indexes based on whether they are US or not."""
+def refresh_sensors(key_read, filename = "sensors_index", download_dir = "processed", log_file_path = LOG_FILE_PATH,
+                    transport = None, instrumentation = None):
+    """
+    Incremental refresh of the sensor index.
+
+    Requests only the sensors modified since the API time stamp of the last refresh (kept in the log) and
+    upserts them into the stored sensor index. A second, sensor_index-only request lists the current sensors,
+    and sensors missing from it are marked with removed = 1. Falls back to a full get_sensors when there is
+    no stored index or no recorded time stamp.
+
+    Returns the updated DataFrame of the sensor index.
+    """
+    import pandas as pd
     
-    if os.path.exists(os.path.join(download_dir, filename + '.csv')):
-        sensors_index = pd.read_csv(os.path.join(download_dir, filename + '.csv'))
-    else:
+    out_dir = os.path.join(download_dir, filename + ".csv")
+    with open_sensor_log(log_file_path) as sensor_log:
+        last_time_stamp = sensor_log.get_meta("sensors_index.csv time_stamp")
+    
+    if not os.path.exists(out_dir) or last_time_stamp is None:
+        print("No previous refresh recorded: downloading the full sensor list.")
+        return get_sensors(key_read=key_read, filename=filename, download_dir=download_dir, transport=transport,
+                           instrumentation=instrumentation, log_file_path=log_file_path)
+    
+    # Sensors modified since the last refresh, and the indices of all current sensors
+    delta, api_time_stamp = _fetch_sensors(key_read, SENSOR_FIELDS, f'&modified_since={last_time_stamp}', transport,
+                                           instrumentation)
+    current, _ = _fetch_sensors(key_read, ['sensor_index'], transport=transport, instrumentation=instrumentation)
+    
+    delta = pd.DataFrame(_prepare_sensors(delta, previous_index_path=out_dir, cache_dir=os.path.join(download_dir, "cache")))
+    delta['removed'] = 0
+    
+    # Upsert: replace the modified sensors and add the new ones
+    sensors_index = pd.read_csv(out_dir)
+    sensors_index = sensors_index[~sensors_index['sensor_index'].isin(delta['sensor_index'])]
+    sensors_index = pd.concat([sensors_index, delta], ignore_index=True).sort_values('sensor_index')
+    
+    # Mark sensors that are no longer listed by the API
+    sensors_index['removed'] = (~sensors_index['sensor_index'].isin(current['sensor_index'])).astype(int)
+    
+    sensors_index.to_csv(out_dir, index=False, header=True)
+    print(f"{len(delta)} modified sensors upserted, {int(sensors_index['removed'].sum())} sensors marked as removed in: {out_dir}")
+    
+    update_sensor_index_log(log_file_path, delta['sensor_index'].tolist(), datetime.now().date(), api_time_stamp)
+    
+    return sensors_index
+
+def get_sensorslist(key_read, filename = "sensors_index", download_dir = "processed", refresh = False,
+                    log_file_path = LOG_FILE_PATH):
+    """
+    Retrieve sensor indexes based on whether they are US or not. With refresh, the index is first updated by refresh_sensors.
+
+    The lists come from the cached SensorIndex, so the CSV is parsed again only after it changed.
+    """
+    
+    index_path = os.path.join(download_dir, filename + '.csv')
+    if refresh:
+        refresh_sensors(key_read = key_read, filename=filename, download_dir = download_dir, log_file_path = log_file_path)
+    elif not os.path.exists(index_path):
         # call get_sensors to new lists of sensor
-        sensors_index = get_sensors(key_read = key_read, filename=filename, download_dir = "processed")
+        get_sensors(key_read = key_read, filename=filename, download_dir = download_dir, log_file_path = log_file_path)
+    
+    return SensorIndex.load(index_path).groups()
+
+class SensorIndex:
+    """
+    The sensor index as typed NumPy columns, with a grid index over latitude and longitude.
+
+    load() converts sensors_index.csv once into an Arrow IPC file in the cache folder
+    (without the WKT geometry), sorted by grid cell, and later calls memory-map that file.
+    The cache file is named after the CSV, and its schema metadata records the path, size
+    and modification time of the CSV it was built from.
+    Spatial queries read only the cells that overlap the query: each row of cells is one
+    contiguous slice of the sorted columns, found by binary search. Attribute filters are
+    then applied to the candidates only.
+    """
+
+    # Cache columns: NumPy dtype and the fill value of missing entries
+    COLUMNS = {
+        "sensor_index": ("int64", -1),
+        "latitude": ("float64", float("nan")),
+        "longitude": ("float64", float("nan")),
+        "location_type": ("int8", -1),
+        "position_rating": ("int8", -1),
+        "us": ("int8", -1),
+        "removed": ("int8", 0),
+        "date_created": ("int64", -1),
+        "last_seen": ("int64", -1)
+    }
+
+    def __init__(self, table, cell_degrees=1.0):
+        import numpy as np
+        self.table = table
+        self.cell_degrees = cell_degrees
+        self.n_columns = int(np.ceil(360 / cell_degrees))
+        for name in list(self.COLUMNS) + ["cell"]:
+            setattr(self, name, table[name].to_numpy())
+
+    @classmethod
+    def from_csv(cls, index_path, cell_degrees=1.0):
+        """Build the index from a sensors_index.csv."""
+        import pandas as pd
+        import numpy as np
+        import pyarrow as pa
+        header = pd.read_csv(index_path, nrows=0).columns
+        df = pd.read_csv(index_path, usecols=[name for name in cls.COLUMNS if name in header] + ['name'])
+        columns = {}
+        for name, (dtype, fill) in cls.COLUMNS.items():
+            if name not in df.columns:
+                values = np.full(len(df), fill)
+            elif name in ("date_created", "last_seen"):
+                dates = pd.to_datetime(df[name], utc=True)
+                values = np.where(dates.notna(), (dates - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1), fill)
+            else:
+                values = df[name].fillna(fill).to_numpy()
+            columns[name] = values.astype(dtype)
+        
+        # Grid cell of each sensor; sensors without coordinates get cell -1
+        rows = np.floor((columns["latitude"] + 90) / cell_degrees)
+        cols = np.floor((columns["longitude"] + 180) / cell_degrees)
+        n_columns = int(np.ceil(360 / cell_degrees))
+        cell = np.where(np.isnan(rows) | np.isnan(cols), -1, rows * n_columns + np.minimum(cols, n_columns - 1))
+        columns["cell"] = cell.astype(np.int64)
+        
+        order = np.lexsort((columns["sensor_index"], columns["cell"]))
+        table = pa.table({name: values[order] for name, values in columns.items()})
+        table = table.append_column("name", pa.array(df['name'].astype(object).where(df['name'].notna(), None).to_numpy()[order],
+                                                     type=pa.string()))
+        return cls(table.replace_schema_metadata({"cell_degrees": str(cell_degrees)}), cell_degrees)
+
+    @classmethod
+    def load(cls, index_path="processed/sensors_index.csv", cache_dir=None, cell_degrees=1.0):
+        """The index of a sensors_index.csv, from the cache when it was built from this very file."""
+        import pyarrow as pa
+        cache_dir = cache_dir or os.path.join(os.path.dirname(index_path), "cache")
+        cache_file = os.path.join(cache_dir, os.path.splitext(os.path.basename(index_path))[0] + ".arrow")
+        stat = os.stat(index_path)
+        source = {"cell_degrees": str(cell_degrees), "source_path": os.path.abspath(index_path),
+                  "source_size": str(stat.st_size), "source_mtime_ns": str(stat.st_mtime_ns)}
+        if os.path.exists(cache_file):
+            table = pa.ipc.open_file(pa.memory_map(cache_file)).read_all()
+            metadata = {key.decode(): value.decode() for key, value in (table.schema.metadata or {}).items()}
+            if all(metadata.get(key) == value for key, value in source.items()):
+                return cls(table, cell_degrees)
+        
+        index = cls.from_csv(index_path, cell_degrees)
+        index.table = index.table.replace_schema_metadata(source)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f"{cache_file}.{uuid.uuid4().hex[:8]}.tmp"
+        with pa.OSFile(tmp_file, "wb") as sink, pa.ipc.new_file(sink, index.table.schema) as writer:
+            writer.write_table(index.table)
+        os.replace(tmp_file, cache_file)
+        return index
+
+    def __len__(self):
+        return len(self.sensor_index)
+
+    def _cell_range(self, latitude_min, latitude_max, longitude_min, longitude_max):
+        import numpy as np
+        # Positions of the sensors in the cells overlapping the box (longitude_min <= longitude_max)
+        row_min = int(np.floor((max(latitude_min, -90) + 90) / self.cell_degrees))
+        row_max = int(np.floor((min(latitude_max, 90) + 90) / self.cell_degrees))
+        col_min = int(np.floor((max(longitude_min, -180) + 180) / self.cell_degrees))
+        col_max = min(int(np.floor((min(longitude_max, 180) + 180) / self.cell_degrees)), self.n_columns - 1)
+        first_cells = np.arange(row_min, row_max + 1) * self.n_columns + col_min
+        starts = np.searchsorted(self.cell, first_cells, side='left')
+        ends = np.searchsorted(self.cell, first_cells + (col_max - col_min), side='right')
+        if not len(starts):
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+
+    def _box_positions(self, longitude_min, latitude_min, longitude_max, latitude_max):
+        import numpy as np
+        # A box across the antimeridian (longitude_min > longitude_max) is split in two
+        if longitude_min > longitude_max:
+            positions = np.concatenate([self._cell_range(latitude_min, latitude_max, longitude_min, 180),
+                                        self._cell_range(latitude_min, latitude_max, -180, longitude_max)])
+        else:
+            positions = self._cell_range(latitude_min, latitude_max, longitude_min, longitude_max)
+        latitude, longitude = self.latitude[positions], self.longitude[positions]
+        inside = (latitude >= latitude_min) & (latitude <= latitude_max)
+        if longitude_min > longitude_max:
+            inside &= (longitude >= longitude_min) | (longitude <= longitude_max)
+        else:
+            inside &= (longitude >= longitude_min) & (longitude <= longitude_max)
+        return positions[inside]
+
+    def _radius_positions(self, latitude, longitude, radius_km):
+        import numpy as np
+        # Candidates from the bounding box of the circle, then the exact haversine distance
+        latitude_delta = np.degrees(radius_km / 6371.0)
+        if abs(latitude) + latitude_delta >= 90:
+            longitude_min, longitude_max = -180, 180
+        else:
+            longitude_delta = np.degrees(radius_km / (6371.0 * np.cos(np.radians(abs(latitude) + latitude_delta))))
+            longitude_min = (longitude - longitude_delta + 180) % 360 - 180 if longitude_delta < 180 else -180
+            longitude_max = (longitude + longitude_delta + 180) % 360 - 180 if longitude_delta < 180 else 180
+        positions = self._box_positions(longitude_min, latitude - latitude_delta, longitude_max, latitude + latitude_delta)
+        
+        lat1, lon1 = np.radians(latitude), np.radians(longitude)
+        lat2, lon2 = np.radians(self.latitude[positions]), np.radians(self.longitude[positions])
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        return positions[2 * 6371.0 * np.arcsin(np.sqrt(np.minimum(a, 1))) <= radius_km]
+
+    def _polygon_positions(self, polygon):
+        import shapely
+        if not isinstance(polygon, shapely.Geometry):
+            polygon = shapely.Polygon(polygon)
+        longitude_min, latitude_min, longitude_max, latitude_max = shapely.bounds(polygon)
+        positions = self._box_positions(longitude_min, latitude_min, longitude_max, latitude_max)
+        return positions[shapely.contains_xy(polygon, self.longitude[positions], self.latitude[positions])]
+
+    def select(self, bbox=None, center=None, radius_km=None, polygon=None, location_type=None,
+               min_position_rating=None, seen_since=None, seen_within=None, us=None, include_removed=False):
+        """
+        Sensor indices (sorted) matching every given condition.
+
+        bbox (tuple, optional): (longitude_min, latitude_min, longitude_max, latitude_max); longitude_min > longitude_max crosses the antimeridian.
+        center, radius_km (optional): (latitude, longitude) and a distance in km (great-circle).
+        polygon (optional): A shapely geometry or a list of (longitude, latitude) vertices. Needs shapely.
+        location_type (int, optional): 0 for outside, 1 for inside.
+        min_position_rating (int, optional): Lowest position_rating (0 to 5).
+        seen_since (string or datetime, optional): Last seen at or after this time (UTC).
+        seen_within (float or timedelta, optional): Last seen within this many seconds from now.
+        us (int, optional): 1 for sensors in the U.S., 0 for the others.
+        include_removed (bool, optional): Keep sensors marked as removed by refresh_sensors (default: False).
+        """
+        import numpy as np
         
-    # replace this with get_sensor function later!
-    # all_sensorlist = gdf_sensorlist['sensor_index'].tolist()
+        positions = None
+        if bbox is not None:
+            positions = self._box_positions(*bbox)
+        if center is not None:
+            found = self._radius_positions(center[0], center[1], radius_km)
+            positions = found if positions is None else np.intersect1d(positions, found)
+        if polygon is not None:
+            found = self._polygon_positions(polygon)
+            positions = found if positions is None else np.intersect1d(positions, found)
+        if positions is None:
+            positions = np.arange(len(self))
         
-    # subset us_indoor and us_oudoor sensors
-    # us_sensorlist = sensors_index[sensors_index['us'] == 1]['sensor_index'].tolist()
-    us_indoor_sensorlist = sensors_index[(sensors_index['us'] == 1) & (sensors_index['location_type'] == 1)]['sensor_index'].tolist()
-    us_outdoor_sensorlist = sensors_index[(sensors_index['us'] == 1) & (sensors_index['location_type'] == 0)]['sensor_index'].tolist()
-    
-    # non_us_indoor and non_us_outdoor sensors
-    nonus_sensorlist = sensors_index[sensors_index['us'] == 0]['sensor_index'].tolist()
-
-    sensor_dict = {
-        "us_indoor": us_indoor_sensorlist, 
-        "us_outdoor": us_outdoor_sensorlist,
-        "non_us": nonus_sensorlist
+        mask = np.ones(len(positions), dtype=bool)
+        if location_type is not None:
+            mask &= self.location_type[positions] == location_type
+        if min_position_rating is not None:
+            mask &= self.position_rating[positions] >= min_position_rating
+        if seen_within is not None:
+            seconds = seen_within.total_seconds() if isinstance(seen_within, timedelta) else seen_within
+            seen_since = int(time.time() - seconds)
+        if seen_since is not None:
+            mask &= self.last_seen[positions] >= _to_epoch(seen_since)
+        if us is not None:
+            mask &= self.us[positions] == us
+        if not include_removed:
+            mask &= self.removed[positions] != 1
+        return np.sort(self.sensor_index[positions[mask]])
+
+    def groups(self):
+        """The us_indoor, us_outdoor and non_us lists of get_sensorslist. Removed sensors are left out."""
+        return {
+            "us_indoor": self.select(us=1, location_type=1).tolist(),
+            "us_outdoor": self.select(us=1, location_type=0).tolist(),
+            "non_us": self.select(us=0).tolist()
         }
-    
-    return sensor_dict
 
 def calculate_pa_points(n_sensors, begin_time, end_time):
     
     # point each request
     rows = 714
-    columns = 8 + 2
-    point_per_request = int(rows*columns)
+    point_per_request = estimate_points(rows, len(HISTORY_FIELDS))
     
     # find number of days from begin_time: 01-01-2021 to end_time: 12:31:2023
     # Convert strings to datetime objects
@@ -193,6 +1221,7 @@ def calculate_pa_points(n_sensors, begin_time, end_time):
 
 def create_pa_datelist(average_time, bdate, edate):
     """Create a list of date ranges for the historical data period."""
+    import pandas as pd
     
     # Dates of Historical Data period
     # begindate = datetime.fromisoformat(bdate)
@@ -215,265 +1244,2036 @@ def create_pa_datelist(average_time, bdate, edate):
     
     return date_list
 
-def get_historicaldata(sensors_list, 
-                       bdate, 
-                       edate, 
-                       average_time, 
-                       key_read, 
-                       sleep_seconds,
-                       download_dir = "processed"):
-    """
-    Purpose:
+# Fields downloaded by get_historicaldata
+HISTORY_FIELDS = ['pm2.5_atm_a', 'pm2.5_atm_b', 'pm2.5_cf_1_a', 'pm2.5_cf_1_b', 'humidity', 'temperature']
 
-    This function downloads historical sensor data from the PurpleAir API for a given list of sensors over a specified date range. It processes the data, stores it in separate files per sensor, and updates a log to track downloaded data.
+@functools.lru_cache(maxsize=None)
+def history_schema():
+    """
+    Column types of the stored history (HISTORY_SCHEMA): epoch seconds, sensor index and float32 measurements.
+    Built on first use, so that importing the module does not load pyarrow.
+    """
+    import pyarrow as pa
+    return pa.schema(
+        [('time_stamp', pa.int64()), ('sensor_index', pa.int32())] +
+        [(field, pa.float32()) for field in HISTORY_FIELDS]
+    )
 
-    Parameters:
+# Store folders in download_dir: the averaged history, and the instantaneous readings of LiveIngest
+HISTORY_STORE = "pair_data"
+LIVE_STORE = "pair_live"
 
-    sensors_list (list): List of sensor indices to download data for.
-    bdate (string): The beginning date (in ISO format) for the data to be retrieved.
-    edate (string): The ending date (in ISO format) for the data to be retrieved.
-    average_time (int): The average time (in minutes) used for the sensor data.
-    key_read (string): API key to access PurpleAir API.
-    sleep_seconds (int): Time in seconds to wait between consecutive API requests to avoid throttling.
-    
-    Returns:
-    
-    Save Data: The processed data for each sensor is saved in the folder with sensor ID, using a filename that includes the sensor ID and the date range.
-    Log Updates: After processing each sensor, the log file is updated with information about skipped sensors, missing data, and any errors encountered.
+class HistoryStore:
+    """
+    Append-only Parquet store for the downloaded history, partitioned by sensor and month.
 
+    Layout: `{download_dir}/pair_data/sensorID_{sensor}/{YYYY-MM}/`. Every downloaded window
+    is written as its own `part-*.parquet` chunk, so the cost of a window depends only on
+    its own rows. `compact_partition` merges the chunks of one month into `data.parquet`,
+    removing duplicate time stamps. LiveIngest uses the same layout under pair_live/
+    (store_name=LIVE_STORE), so its readings never share a partition with the averaged history.
     """
+
+    def __init__(self, download_dir="processed", store_name=HISTORY_STORE):
+        self.root = os.path.join(download_dir, store_name)
+        os.makedirs(self.root, exist_ok=True)
+
+    def partition_dir(self, sensor, month):
+        return os.path.join(self.root, f"sensorID_{sensor}", month)
+
+    def sensors(self):
+        """Sensors that have data in the store."""
+        return sorted(int(name[len("sensorID_"):]) for name in os.listdir(self.root)
+                      if name.startswith("sensorID_") and os.path.isdir(os.path.join(self.root, name)))
+
+    def months(self, sensor):
+        """Months (YYYY-MM) that have data for a sensor."""
+        sensor_dir = os.path.join(self.root, f"sensorID_{sensor}")
+        if not os.path.isdir(sensor_dir):
+            return []
+        return sorted(name for name in os.listdir(sensor_dir) if os.path.isdir(os.path.join(sensor_dir, name)))
+
+    def partition_files(self, sensor, month):
+        partition = self.partition_dir(sensor, month)
+        if not os.path.isdir(partition):
+            return []
+        return sorted(os.path.join(partition, name) for name in os.listdir(partition) if name.endswith(".parquet"))
+
+    @staticmethod
+    def to_table(df):
+        """Convert a history DataFrame to a table with HISTORY_SCHEMA."""
+        import pandas as pd
+        import pyarrow as pa
+        df = df.copy()
+        if not pd.api.types.is_integer_dtype(df['time_stamp']):
+            time_stamp = pd.to_datetime(df['time_stamp'], utc=True)
+            df['time_stamp'] = (time_stamp - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+        for field in history_schema().names:
+            if field not in df.columns:
+                df[field] = float('nan')
+        return pa.Table.from_pandas(df[history_schema().names], schema=history_schema(), preserve_index=False, safe=False)
+
+    def append(self, data):
+        """
+        Write a window of history (a DataFrame, or a table from decode_history) as new chunks, one per (sensor, month).
+
+        Returns the list of (sensor, month) partitions that were written.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        import pyarrow.compute as pc
+        table = data if isinstance(data, pa.Table) else self.to_table(data)
+        if table.num_rows == 0:
+            return []
+
+        table = table.sort_by([('sensor_index', 'ascending'), ('time_stamp', 'ascending')])
+        months = pc.strftime(table['time_stamp'].cast(pa.timestamp('s')), format='%Y-%m')
+        keys = pa.table({'sensor_index': table['sensor_index'], 'month': months})
+
+        partitions = []
+        for key in keys.group_by(['sensor_index', 'month']).aggregate([]).to_pylist():
+            sensor, month = key['sensor_index'], key['month']
+            rows = table.filter(pc.and_(pc.equal(table['sensor_index'], sensor), pc.equal(months, month)))
+            partition = self.partition_dir(sensor, month)
+            os.makedirs(partition, exist_ok=True)
+            chunk_file = os.path.join(partition, f"part-{rows['time_stamp'][0].as_py()}-{uuid.uuid4().hex[:8]}.parquet")
+            pq.write_table(rows, chunk_file)
+            partitions.append((int(sensor), month))
+        return partitions
+
+    def compact_partition(self, sensor, month):
+        """Merge all chunks of one partition into data.parquet. Returns the number of rows kept."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        files = self.partition_files(sensor, month)
+        if len(files) < 2 and all(os.path.basename(file) == "data.parquet" for file in files):
+            return None
+
+        table = pa.concat_tables([pq.read_table(file, schema=history_schema()) for file in files])
+        df = table.to_pandas().drop_duplicates(subset='time_stamp', keep='last').sort_values('time_stamp')
+
+        # Write the merged file next to the chunks, then swap it in
+        partition = self.partition_dir(sensor, month)
+        tmp_file = os.path.join(partition, ".data.parquet.tmp")
+        pq.write_table(pa.Table.from_pandas(df, schema=history_schema(), preserve_index=False), tmp_file)
+        os.replace(tmp_file, os.path.join(partition, "data.parquet"))
+        for file in files:
+            if os.path.basename(file) != "data.parquet":
+                os.remove(file)
+        return len(df)
+
+    def compact(self, sensors=None):
+        """Compact every partition of the given sensors (default: all sensors)."""
+        for sensor in (self.sensors() if sensors is None else sensors):
+            for month in self.months(sensor):
+                self.compact_partition(sensor, month)
+
+    def import_csv(self, csv_file):
+        """Import a CSV written by earlier versions of get_historicaldata. Returns the partitions written."""
+        import pandas as pd
+        df = pd.read_csv(csv_file)
+        if df.empty:
+            return []
+        partitions = self.append(df)
+        for sensor, month in partitions:
+            self.compact_partition(sensor, month)
+        return partitions
+
+def decode_history(content):
+    """
+    Decode the body of a history/csv response into a table with HISTORY_SCHEMA.
+
+    The raw bytes are parsed by the pyarrow CSV reader with fixed column types: time_stamp as int64 epoch
+    seconds, sensor_index as int32 and the measurements as float32. There is no text or StringIO round-trip
+    and no second time stamp parse. Missing fields are filled with nulls. An empty body gives an empty table.
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    
+    if not content or not content.strip():
+        return history_schema().empty_table()
+    
+    column_types = {field.name: field.type for field in history_schema()}
+    column_types['time_stamp'] = pa.timestamp('s', tz='UTC')
+    table = pacsv.read_csv(
+        pa.BufferReader(content),
+        convert_options=pacsv.ConvertOptions(column_types=column_types,
+                                             include_columns=history_schema().names,
+                                             include_missing_columns=True)
+    )
+    return table.set_column(0, 'time_stamp', table['time_stamp'].cast(pa.int64())).cast(history_schema())
+
+def migrate_csv_history(download_dir="processed"):
+    """Move the old sensorID_{sensor}_{min_date}_{max_date}.csv files into the Parquet store."""
+    
+    store = HistoryStore(download_dir)
+    for csv_file in glob.glob(os.path.join(store.root, "sensorID_*.csv")):
+        try:
+            store.import_csv(csv_file)
+            os.remove(csv_file)
+            print(f"{csv_file} moved into {store.root}")
+        except Exception as e:
+            print(f"Error importing {csv_file}: {e}")
+    return store
+
+def _to_epoch(value):
+    """Epoch seconds of a date ('%Y-%m-%d', ISO string, datetime or epoch seconds); naive dates are UTC."""
+    import pandas as pd
+    import numpy as np
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize('UTC')
+    return int(timestamp.timestamp())
+
+def _history_files(store, sensor, start, end):
+    """Files of the partitions of a sensor that overlap [start, end), and whether a partition has uncompacted chunks."""
+    first_month = _epoch_to_iso(start)[:7] if start is not None else None
+    last_month = _epoch_to_iso(end - 1)[:7] if end is not None else None
+    files = []
+    chunked = False
+    for month in store.months(sensor):
+        if (first_month is None or month >= first_month) and (last_month is None or month <= last_month):
+            partition_files = store.partition_files(sensor, month)
+            files += partition_files
+            chunked = chunked or len(partition_files) > 1
+    return files, chunked
+
+def _read_history(files, columns, time_filter, average, deduplicate, memory_map):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+    # Row groups outside the time range are skipped using the Parquet statistics
+    dataset = ds.dataset(files, schema=history_schema(), format="parquet",
+                         filesystem=pafs.LocalFileSystem(use_mmap=memory_map))
+    table = dataset.to_table(columns=columns, filter=time_filter)
+    
+    if deduplicate:
+        # Chunks that were not compacted yet may repeat time stamps: keep the rows compact_partition would keep
+        df = table.to_pandas().drop_duplicates(subset=['sensor_index', 'time_stamp'], keep='last')
+        table = pa.Table.from_pandas(df, schema=table.schema, preserve_index=False)
+    
+    fields = [column for column in columns if column not in ('time_stamp', 'sensor_index')]
+    if average:
+        # Mean of each field over buckets of `average` minutes, labelled by the bucket start
+        seconds = average * 60
+        bucket = pc.multiply(pc.divide(table['time_stamp'], seconds), seconds)
+        table = table.set_column(table.schema.get_field_index('time_stamp'), 'time_stamp', bucket)
+        table = table.group_by(['sensor_index', 'time_stamp']).aggregate([(field, 'mean') for field in fields])
+        table = table.rename_columns([name[:-len('_mean')] if name.endswith('_mean') else name
+                                      for name in table.column_names])
+        table = table.select(columns).cast(pa.schema([history_schema().field(column) for column in columns]))
+    
+    table = table.sort_by([('sensor_index', 'ascending'), ('time_stamp', 'ascending')])
+    table = table.set_column(table.schema.get_field_index('time_stamp'), 'time_stamp',
+                             table['time_stamp'].cast(pa.timestamp('s', tz='UTC')))
+    return table.to_pandas()
+
+def load_history(sensors=None, start=None, end=None, fields=None, average=None, download_dir="processed",
+                 chunk_rows=None, memory_map=True, store_name=HISTORY_STORE):
+    """
+    Read the downloaded history from the Parquet store.
+
+    Only the partitions of the requested sensors and months are opened, row groups outside
+    [start, end) are skipped using the Parquet statistics, and only the requested columns are read.
+
+    Parameters:
+
+    sensors (list, optional): Sensor indices (default: every sensor in the store).
+    start, end (string or datetime, optional): Time range [start, end), e.g. '2021-01-01'; naive dates are UTC (default: no limit).
+    fields (list, optional): Fields from HISTORY_FIELDS to read (default: all of them). time_stamp and sensor_index are always returned.
+    average (int, optional): Average the fields over buckets of this many minutes, e.g. 60 for hourly means of 10-minute data (default: the stored rows).
+    download_dir (string, optional): Folder holding pair_data/ (default: "processed").
+    chunk_rows (int, optional): Return an iterator of DataFrames instead of one DataFrame. Each chunk holds
+        whole sensors and about chunk_rows rows (more when one sensor alone has more rows).
+    memory_map (bool, optional): Memory-map the Parquet files instead of reading them into buffers (default: True).
+    store_name (string, optional): Store folder in download_dir: HISTORY_STORE ("pair_data") or LIVE_STORE ("pair_live", the readings of LiveIngest).
+
+    Returns:
+
+    A DataFrame (or an iterator of DataFrames) with time_stamp (UTC datetime), sensor_index and the fields,
+    sorted by sensor_index and time_stamp.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+    
+    fields = list(HISTORY_FIELDS if fields is None else fields)
+    unknown = [field for field in fields if field not in HISTORY_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {unknown}. Stored fields: {HISTORY_FIELDS}")
+    columns = ['time_stamp', 'sensor_index'] + fields
+    
+    start = _to_epoch(start) if start is not None else None
+    end = _to_epoch(end) if end is not None else None
+    time_filter = None
+    if start is not None:
+        time_filter = ds.field('time_stamp') >= start
+    if end is not None:
+        end_filter = ds.field('time_stamp') < end
+        time_filter = end_filter if time_filter is None else time_filter & end_filter
+    
+    store = HistoryStore(download_dir, store_name)
+    sensors = store.sensors() if sensors is None else sorted(int(sensor) for sensor in sensors)
     
-    # Load the download log file
-    log_file_path = 'sensor_log.json'
-    try:
-        with open(log_file_path, 'r') as log_file:
-            log_data = json.load(log_file)
-    except (FileNotFoundError, json.JSONDecodeError):
-        log_data = {"sensors_skipped": [], "url_issue": {}, "no_data": {}}
-    
-    # Historical API URL: for multiple sensors
-    root_api_url = 'https://api.purpleair.com/v1/sensors/'
-    
-    # Average time parameter for API
-    average_api = f'&average={average_time}'
-    
-    # Create the fields API URL
-    fields_list = ['pm2.5_atm_a', 'pm2.5_atm_b', 'pm2.5_cf_1_a', 'pm2.5_cf_1_b', 'humidity', 'temperature']
-    fields_api_url = '&fields=' + '%2C'.join(fields_list)
-    
-    print("CHECK POINT 1: Fields API URL")
-    print(fields_api_url)
-    
-    # --------------------- Jay
-    # Retrieve sensor index for us_indoor
-    us_indoor_sensors = pd.read_csv("data/indoor_us_jay.csv")
-    us_indoor_sensorlist_jay = us_indoor_sensors['sensor_index'].tolist()
-    # Generate date list to skip data for certain us_indoor sensors (from 2021-01-01 to 2023-12-31)
-    check_datelist = create_pa_datelist(average_time, '2021-01-01', '2023-12-31')
+    def read_chunks():
+        files, deduplicate, n_rows = [], False, 0
+        for sensor in sensors:
+            sensor_files, chunked = _history_files(store, sensor, start, end)
+            if not sensor_files:
+                continue
+            files += sensor_files
+            deduplicate = deduplicate or chunked
+            # Rows in the file footers: an upper bound of the rows in the time range
+            n_rows += sum(pq.ParquetFile(file).metadata.num_rows for file in sensor_files)
+            if n_rows >= chunk_rows:
+                yield _read_history(files, columns, time_filter, average, deduplicate, memory_map)
+                files, deduplicate, n_rows = [], False, 0
+        if files:
+            yield _read_history(files, columns, time_filter, average, deduplicate, memory_map)
+    
+    if chunk_rows:
+        return read_chunks()
+    
+    files, deduplicate = [], False
+    for sensor in sensors:
+        sensor_files, chunked = _history_files(store, sensor, start, end)
+        files += sensor_files
+        deduplicate = deduplicate or chunked
+    if not files:
+        empty = history_schema().empty_table().select(columns)
+        return empty.set_column(0, 'time_stamp', empty['time_stamp'].cast(pa.timestamp('s', tz='UTC'))).to_pandas()
+    return _read_history(files, columns, time_filter, average, deduplicate, memory_map)
+
+# QA and correction settings of run_qa
+QA_CONFIG_PATH = 'data/qa_config.json'
+
+# Bits of the qa_flags column
+QA_AB_DISAGREE = 1   # the A and B channels disagree
+QA_OUT_OF_RANGE = 2  # a PM, humidity or temperature value outside its valid range
+QA_STUCK = 4         # a channel repeats the same value for stuck_rows rows or more
+QA_MISSING = 8       # a channel or the humidity is missing: no correction
+
+@functools.lru_cache(maxsize=None)
+def qa_schema():
+    """Columns of the QA dataset (QA_SCHEMA), written next to the raw data in pair_qa/."""
+    import pyarrow as pa
+    return pa.schema([
+        ('time_stamp', pa.int64()),
+        ('sensor_index', pa.int32()),
+        ('pm2.5_cf_1', pa.float32()),
+        ('pm2.5_corrected', pa.float32()),
+        ('qa_flags', pa.uint8())
+    ])
+
+def __getattr__(name):
+    # HISTORY_SCHEMA and QA_SCHEMA stay importable, built on first access
+    if name == "HISTORY_SCHEMA":
+        return history_schema()
+    if name == "QA_SCHEMA":
+        return qa_schema()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class QAPipeline:
+    """
+    A/B channel QA and humidity correction of the stored history, as array operations over many sensors.
+
+    The config (a JSON object, see data/qa_config.json) overrides DEFAULTS; ranges and correction are
+    merged key by key, so a config may override a single range or coefficient:
+
+    ab_abs_diff, ab_rel_diff: the channels disagree when |A - B| is above ab_abs_diff (ug/m3) and above
+        ab_rel_diff times their mean.
+    ranges: valid [min, max] of the PM fields, the humidity (%) and the temperature (F).
+    stuck_rows: a run of this many identical non-zero values of a channel flags the run as stuck.
+    correction: linear correction of the channel mean pm2.5_cf_1, clipped at 0: intercept + the sum of
+        coefficient * column over the other keys. The default is the U.S. EPA correction
+        (Barkjohn et al., 2021): 0.524 * PM2.5_cf_1 - 0.0862 * RH + 5.75. Set a coefficient to 0 to drop its term.
+    """
+
+    DEFAULTS = {
+        "ab_abs_diff": 5.0,
+        "ab_rel_diff": 0.7,
+        "ranges": {"pm2.5": [0, 1000], "humidity": [0, 100], "temperature": [-40, 185]},
+        "stuck_rows": 12,
+        "correction": {"intercept": 5.75, "pm2.5_cf_1": 0.524, "humidity": -0.0862}
+    }
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.config = dict(self.DEFAULTS, **config)
+        for key in ["ranges", "correction"]:
+            self.config[key] = dict(self.DEFAULTS[key], **config.get(key, {}))
+
+    @classmethod
+    def from_config(cls, config_path=QA_CONFIG_PATH):
+        """Load the settings from a JSON config file. A missing file means the defaults."""
+        if not config_path or not os.path.exists(config_path):
+            return cls()
+        with open(config_path, 'r') as config_file:
+            return cls(json.load(config_file))
+
+    def _stuck(self, values, sensors):
+        import numpy as np
+        # Runs of identical values within a sensor, found with one pass over the whole batch
+        same = (values[1:] == values[:-1]) & (sensors[1:] == sensors[:-1]) & (values[1:] != 0)
+        run_ids = np.concatenate([[0], np.cumsum(~same)])
+        return np.bincount(run_ids)[run_ids] >= self.config["stuck_rows"]
+
+    def evaluate(self, table):
+        """
+        QA flags and corrected PM2.5 of a history table sorted by sensor_index and time_stamp.
+
+        Returns a table with QA_SCHEMA, row for row.
+        """
+        import numpy as np
+        import pyarrow as pa
+        columns = {name: table[name].to_numpy(zero_copy_only=False) for name in table.column_names}
+        sensors = columns['sensor_index']
+        a = columns['pm2.5_cf_1_a'].astype(np.float64)
+        b = columns['pm2.5_cf_1_b'].astype(np.float64)
+        humidity = columns['humidity'].astype(np.float64)
+        mean = (a + b) / 2
+        flags = np.zeros(len(a), dtype=np.uint8)
         
-    # Process each sensor
-    for sensor in sensors_list:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            difference = np.abs(a - b)
+            flags[(difference > self.config["ab_abs_diff"]) & (difference > self.config["ab_rel_diff"] * mean)] |= QA_AB_DISAGREE
+            
+            ranges = self.config["ranges"]
+            out_of_range = np.zeros(len(a), dtype=bool)
+            for name in ['pm2.5_atm_a', 'pm2.5_atm_b', 'pm2.5_cf_1_a', 'pm2.5_cf_1_b', 'humidity', 'temperature']:
+                low, high = ranges["pm2.5" if name.startswith("pm2.5") else name]
+                values = columns[name]
+                out_of_range |= (values < low) | (values > high)
+            flags[out_of_range] |= QA_OUT_OF_RANGE
         
-        # Ensure sensor exists in log_data, or initialize it
-        if str(sensor) not in log_data:
-            log_data[str(sensor)] = {"url_issue": [], "no_data": []}
+        flags[self._stuck(a, sensors) | self._stuck(b, sensors)] |= QA_STUCK
+        flags[np.isnan(a) | np.isnan(b) | np.isnan(humidity)] |= QA_MISSING
         
-        # create new folder for a sensor
-        # sensor_folder = os.path.join(download_dir, f"sensorID_{sensor}")
-        # os.makedirs(sensor_folder, exist_ok=True)  # Create sensor folder if it doesn't exist
+        # Linear correction of the channel mean
+        terms = {'pm2.5_cf_1': mean, **{name: columns[name].astype(np.float64) for name in HISTORY_FIELDS}}
+        correction = self.config["correction"]
+        corrected = np.full(len(a), float(correction.get("intercept", 0.0)))
+        for name, coefficient in correction.items():
+            if name != "intercept":
+                corrected += coefficient * terms[name]
+        corrected = np.maximum(corrected, 0)
         
-        # create new data folder
-        data_folder = os.path.join(download_dir, "pair_data")
-        os.makedirs(data_folder, exist_ok = True)
+        return pa.table({
+            'time_stamp': table['time_stamp'],
+            'sensor_index': table['sensor_index'],
+            'pm2.5_cf_1': mean.astype(np.float32),
+            'pm2.5_corrected': corrected.astype(np.float32),
+            'qa_flags': flags
+        }, schema=qa_schema())
+
+def _write_parquet(table, path):
+    import pyarrow.parquet as pq
+    # Write next to the target, then swap it in
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+def qa_partition_path(download_dir, sensor, month):
+    return os.path.join(download_dir, "pair_qa", f"sensorID_{sensor}", month, "data.parquet")
+
+def _dirty_partitions(store, sensors, output_path, partitions=None):
+    # A partition is dirty when its raw files are newer than the output derived from it, output_path(sensor, month).
+    # Only the given (sensor, month) partitions are checked, else every partition of the sensors
+    if partitions is None:
+        partitions = [(sensor, month) for sensor in sensors for month in store.months(sensor)]
+    dirty = []
+    for sensor, month in sorted(set((int(sensor), month) for sensor, month in partitions)):
+        files = store.partition_files(sensor, month)
+        if not files:
+            continue
+        path = output_path(sensor, month)
+        output_mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        if output_mtime is None or max(os.path.getmtime(file) for file in files) > output_mtime:
+            dirty.append((sensor, month))
+    return dirty
+
+def run_qa(download_dir="processed", sensors=None, config_path=QA_CONFIG_PATH, batch_rows=1_000_000, partitions=None):
+    """
+    Flag and correct the stored history, incrementally.
+
+    Only (sensor, month) partitions whose raw data changed since their last QA run are processed:
+    partitions with new windows are compacted first, then read in batches of many sensors (about
+    batch_rows rows) and evaluated by QAPipeline as array operations over the whole batch. The QA
+    columns (QA_SCHEMA) are written to a parallel dataset, {download_dir}/pair_qa/sensorID_{sensor}/{YYYY-MM}/data.parquet,
+    row for row with the raw partition; join them on sensor_index and time_stamp.
+
+    Stuck runs are detected within a partition, so a run that crosses a month boundary counts as two runs.
+
+    The partitions checked are those of sensors (default: all sensors in the store), or only the given
+    (sensor, month) partitions, e.g. the "partitions" of the stats of get_historicaldata, so that the
+    partitions of the other sensors are not even listed.
+
+    Returns the number of partitions processed.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    pipeline = QAPipeline.from_config(config_path)
+    store = HistoryStore(download_dir)
+    sensors = store.sensors() if sensors is None else sorted(int(sensor) for sensor in sensors)
+    dirty = _dirty_partitions(store, sensors, lambda sensor, month: qa_partition_path(download_dir, sensor, month),
+                              partitions)
+    
+    def process(batch):
+        tables = [pq.read_table(store.partition_files(sensor, month)[0], schema=history_schema()) for sensor, month in batch]
+        result = pipeline.evaluate(pa.concat_tables(tables))
+        offset = 0
+        for (sensor, month), table in zip(batch, tables):
+            _write_parquet(result.slice(offset, table.num_rows), qa_partition_path(download_dir, sensor, month))
+            offset += table.num_rows
+    
+    batch, n_rows = [], 0
+    for sensor, month in dirty:
+        # One sorted file per partition, so the batch is sorted by sensor and time
+        store.compact_partition(sensor, month)
+        batch.append((sensor, month))
+        n_rows += pq.ParquetFile(store.partition_files(sensor, month)[0]).metadata.num_rows
+        if n_rows >= batch_rows:
+            process(batch)
+            batch, n_rows = [], 0
+    if batch:
+        process(batch)
+    
+    print(f"QA: {len(dirty)} partitions processed in {os.path.join(download_dir, 'pair_qa')}")
+    return len(dirty)
+
+# Rollup periods: bucket length in seconds. Hours and days never cross a month, so each
+# sensor-month partition of the store maps to its own rollup partitions.
+ROLLUP_FREQUENCIES = {"hourly": 3600, "daily": 86400}
+
+# Fields aggregated by update_rollups
+ROLLUP_FIELDS = HISTORY_FIELDS
+
+def rollup_partition_path(download_dir, frequency, key, month):
+    """Rollup file of a sensor (key = sensor index) or a region (key = region name) for one month."""
+    name = f"region_{key}" if isinstance(key, str) else f"sensorID_{key}"
+    return os.path.join(download_dir, "rollups", frequency, name, month, "data.parquet")
+
+def rollup_table(table, seconds, fields=ROLLUP_FIELDS):
+    """
+    Aggregate a history table into buckets of `seconds` per sensor.
+
+    Returns a table with time_stamp (bucket start, epoch seconds), sensor_index and, for each field,
+    {field}_count, {field}_sum, {field}_min and {field}_max over the non-null values. These merge
+    across sensors or partitions by adding counts and sums and taking the min of mins and max of maxes.
+    """
+    import pyarrow.compute as pc
+    bucket = pc.multiply(pc.divide(table['time_stamp'], seconds), seconds)
+    table = table.set_column(table.schema.get_field_index('time_stamp'), 'time_stamp', bucket)
+    aggregations = [(field, function) for field in fields for function in ['count', 'sum', 'min', 'max']]
+    result = table.group_by(['sensor_index', 'time_stamp']).aggregate(aggregations)
+    result = result.select(['time_stamp', 'sensor_index'] + [f"{field}_{function}" for field, function in aggregations])
+    return result.sort_by([('sensor_index', 'ascending'), ('time_stamp', 'ascending')])
+
+def _merge_rollups(table, fields=ROLLUP_FIELDS):
+    # Merge the sensor rollups of a region: one row per bucket, plus the number of sensors with data
+    aggregations = [('sensor_index', 'count_distinct')]
+    for field in fields:
+        aggregations += [(f"{field}_count", 'sum'), (f"{field}_sum", 'sum'), (f"{field}_min", 'min'), (f"{field}_max", 'max')]
+    result = table.group_by(['time_stamp']).aggregate(aggregations)
+    names = {'sensor_index_count_distinct': 'sensors'}
+    for field in fields:
+        names.update({f"{field}_count_sum": f"{field}_count", f"{field}_sum_sum": f"{field}_sum",
+                      f"{field}_min_min": f"{field}_min", f"{field}_max_max": f"{field}_max"})
+    result = result.rename_columns([names.get(name, name) for name in result.column_names])
+    return result.select(['time_stamp', 'sensors'] + [name for name in result.column_names
+                                                      if name not in ('time_stamp', 'sensors')]).sort_by('time_stamp')
+
+def _rollup_frame(table):
+    # Rollup of one sensor as a DataFrame indexed by bucket
+    return table.to_pandas().set_index('time_stamp').drop(columns='sensor_index')
 
-        hist_api_url = root_api_url + f'{sensor}/history/csv?api_key={key_read}'
+def _apply_rollup_delta(region, old, new, fields=ROLLUP_FIELDS):
+    # Replace the old rollup of one sensor of a region rollup (DataFrames indexed by bucket) by its new one:
+    # counts, sums and the number of sensors are updated without reading the other sensors. Also returns
+    # the buckets where the old rollup held the min or max and the new one does not reach it: those must be
+    # recomputed from the sensor rollups
+    import numpy as np
+    buckets = region.index.union(old.index).union(new.index)
+    had, has = buckets.isin(old.index), buckets.isin(new.index)
+    region, old, new = region.reindex(buckets), old.reindex(buckets), new.reindex(buckets)
+    result = region[[]].copy()
+    result['sensors'] = region['sensors'].fillna(0) - had + has
+    stale = np.zeros(len(buckets), dtype=bool)
+    for field in fields:
+        count, total, low, high = (f"{field}_{function}" for function in ['count', 'sum', 'min', 'max'])
+        result[count] = region[count].fillna(0) - old[count].fillna(0) + new[count].fillna(0)
+        result[total] = (region[total].fillna(0) - old[total].fillna(0) + new[total].fillna(0)).where(result[count] > 0)
+        result[low] = np.fmin(region[low], new[low])
+        result[high] = np.fmax(region[high], new[high])
+        stale |= ((old[low] <= region[low]) & ~(new[low] <= old[low])).to_numpy()
+        stale |= ((old[high] >= region[high]) & ~(new[high] >= old[high])).to_numpy()
+    keep = (result['sensors'] > 0).to_numpy()
+    return result[keep], buckets[stale & keep]
+
+def _recompute_extremes(frame, buckets, files, fields=ROLLUP_FIELDS):
+    # Min and max of the given buckets of a region rollup, from the rollups of its sensors
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    columns = [f"{field}_{function}" for field in fields for function in ['min', 'max']]
+    filters = [('time_stamp', 'in', [int(bucket) for bucket in buckets])]
+    table = pa.concat_tables([pq.read_table(file, columns=['time_stamp'] + columns, filters=filters) for file in files])
+    extremes = table.group_by('time_stamp').aggregate([(column, column[-3:]) for column in columns]).to_pandas()
+    extremes = extremes.set_index('time_stamp').rename(columns=lambda name: name[:-4]).reindex(buckets)
+    frame.loc[buckets, columns] = extremes[columns].to_numpy()
+
+def update_rollups(download_dir="processed", sensors=None, regions=None, partitions=None):
+    """
+    Maintain the hourly and daily rollups of the stored history, per sensor and per region.
+
+    Only the sensor-month partitions that changed since their rollup was written are aggregated again.
+    The region-months that contain one of them are updated with the difference between the old and the
+    new rollup of the sensor: counts and sums are adjusted, and the min and max are read again from the
+    sensor rollups only for the buckets where the old rollup held them. A region-month without a rollup
+    file yet (delete it to repair a region) is merged from all its sensor rollups.
+
+    Parameters:
+
+    download_dir (string, optional): Folder holding pair_data/ (default: "processed"). Rollups are written to
+        {download_dir}/rollups/{hourly,daily}/sensorID_{sensor}/{YYYY-MM}/data.parquet and .../region_{region}/{YYYY-MM}/data.parquet.
+    sensors (list, optional): Sensors to update (default: all sensors in the store).
+    regions (dict, optional): Region name -> list of sensors, as returned by get_sensorslist
+        (default: us_indoor, us_outdoor and non_us from {download_dir}/sensors_index.csv, if it exists).
+    partitions (list, optional): Only check these (sensor, month) partitions, e.g. the "partitions" of the stats
+        of get_historicaldata, instead of listing every partition of the sensors (default: None).
+
+    Returns:
+
+    The number of sensor-month partitions aggregated.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    store = HistoryStore(download_dir)
+    sensors = store.sensors() if sensors is None else sorted(int(sensor) for sensor in sensors)
+    
+    index_path = os.path.join(download_dir, "sensors_index.csv")
+    if regions is None:
+        regions = SensorIndex.load(index_path).groups() if os.path.exists(index_path) else {}
+    region_of = {int(sensor): region for region, region_sensors in regions.items() for sensor in region_sensors}
+    
+    # The daily file is written last, so its age marks when the partition was rolled up
+    dirty = _dirty_partitions(store, sensors,
+                              lambda sensor, month: rollup_partition_path(download_dir, "daily", sensor, month),
+                              partitions)
+    
+    def sensor_files(region, frequency, month):
+        files = [rollup_partition_path(download_dir, frequency, int(sensor), month) for sensor in regions[region]]
+        return [file for file in files if os.path.exists(file)]
+    
+    # Region rollups being updated, (region, month, frequency) -> (DataFrame, schema), written at the end;
+    # and the region-months without a rollup yet, merged from all their sensors at the end
+    region_tables, rebuild = {}, set()
+    for sensor, month in dirty:
+        store.compact_partition(sensor, month)
+        table = pq.read_table(store.partition_files(sensor, month)[0], schema=history_schema(),
+                              columns=['time_stamp', 'sensor_index'] + ROLLUP_FIELDS)
+        region = region_of.get(sensor)
+        for frequency, seconds in ROLLUP_FREQUENCIES.items():
+            path = rollup_partition_path(download_dir, frequency, sensor, month)
+            old = pq.read_table(path) if os.path.exists(path) else None
+            new = rollup_table(table, seconds)
+            _write_parquet(new, path)
+            
+            key = (region, month, frequency)
+            if region is None or key in rebuild:
+                continue
+            if key not in region_tables:
+                region_path = rollup_partition_path(download_dir, frequency, region, month)
+                if not os.path.exists(region_path):
+                    rebuild.add(key)
+                    continue
+                region_table = pq.read_table(region_path)
+                region_tables[key] = (region_table.to_pandas().set_index('time_stamp'), region_table.schema)
+            new = _rollup_frame(new)
+            old = _rollup_frame(old) if old is not None else new.iloc[:0]
+            frame, stale = _apply_rollup_delta(region_tables[key][0], old, new)
+            if len(stale):
+                _recompute_extremes(frame, stale, sensor_files(region, frequency, month))
+            region_tables[key] = (frame, region_tables[key][1])
+    
+    for (region, month, frequency), (frame, schema) in region_tables.items():
+        table = pa.Table.from_pandas(frame.reset_index(), preserve_index=False).select(schema.names).cast(schema)
+        _write_parquet(table, rollup_partition_path(download_dir, frequency, region, month))
+    for region, month, frequency in rebuild:
+        table = pa.concat_tables([pq.read_table(file) for file in sensor_files(region, frequency, month)])
+        _write_parquet(_merge_rollups(table), rollup_partition_path(download_dir, frequency, region, month))
+    touched = {(region, month) for region, month, _ in list(region_tables) + list(rebuild)}
+    
+    print(f"Rollups: {len(dirty)} sensor-month partitions and {len(touched)} region-months updated")
+    return len(dirty)
+
+def load_rollup(frequency="hourly", sensors=None, region=None, start=None, end=None, fields=None,
+                download_dir="processed"):
+    """
+    Read hourly or daily rollups written by update_rollups.
+
+    Parameters:
+
+    frequency (string, optional): "hourly" or "daily" (default: "hourly").
+    sensors (list, optional): Sensors to read (default: all sensors with rollups).
+    region (string, optional): Read the rollup of a region (e.g. "us_outdoor") instead of sensors.
+    start, end (string or datetime, optional): Bucket range [start, end); naive dates are UTC.
+    fields (list, optional): Fields from ROLLUP_FIELDS (default: all of them).
+    download_dir (string, optional): Folder holding rollups/ (default: "processed").
+
+    Returns:
+
+    A DataFrame with time_stamp (bucket start, UTC), sensor_index (or sensors, the number of sensors with data
+    in a region bucket) and {field}_count, _sum, _min, _max and _mean for each field.
+    """
+    import pandas as pd
+    import pyarrow.dataset as ds
+    
+    fields = list(ROLLUP_FIELDS if fields is None else fields)
+    root = os.path.join(download_dir, "rollups", frequency)
+    if region is not None:
+        keys = [f"region_{region}"]
+    elif sensors is not None:
+        keys = [f"sensorID_{int(sensor)}" for sensor in sorted(sensors)]
+    else:
+        keys = sorted(name for name in os.listdir(root) if name.startswith("sensorID_")) if os.path.isdir(root) else []
+    
+    start = _to_epoch(start) if start is not None else None
+    end = _to_epoch(end) if end is not None else None
+    first_month = _epoch_to_iso(start)[:7] if start is not None else None
+    last_month = _epoch_to_iso(end - 1)[:7] if end is not None else None
+    
+    files = []
+    for key in keys:
+        key_dir = os.path.join(root, key)
+        if not os.path.isdir(key_dir):
+            continue
+        for month in sorted(os.listdir(key_dir)):
+            if (first_month is None or month >= first_month) and (last_month is None or month <= last_month):
+                files.append(os.path.join(key_dir, month, "data.parquet"))
+    if not files:
+        return pd.DataFrame()
+    
+    dataset = ds.dataset(files, format="parquet")
+    columns = ['time_stamp', 'sensors' if region is not None else 'sensor_index']
+    columns += [f"{field}_{function}" for field in fields for function in ['count', 'sum', 'min', 'max']]
+    time_filter = None
+    if start is not None:
+        time_filter = ds.field('time_stamp') >= start
+    if end is not None:
+        end_filter = ds.field('time_stamp') < end
+        time_filter = end_filter if time_filter is None else time_filter & end_filter
+    
+    df = dataset.to_table(columns=columns, filter=time_filter).to_pandas()
+    df['time_stamp'] = pd.to_datetime(df['time_stamp'], unit='s', utc=True)
+    for field in fields:
+        df[f"{field}_mean"] = df[f"{field}_sum"] / df[f"{field}_count"].where(df[f"{field}_count"] > 0)
+    return df
+
+def _iso_to_epoch(date):
+    """Convert a '%Y-%m-%dT%H:%M:%SZ' string to epoch seconds."""
+    return calendar.timegm(datetime.strptime(date, '%Y-%m-%dT%H:%M:%SZ').timetuple())
+
+def _epoch_to_iso(seconds):
+    """Convert epoch seconds to a '%Y-%m-%dT%H:%M:%SZ' string."""
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def merge_intervals(intervals):
+    """Sort [start, end) intervals and merge the ones that overlap or touch."""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def _is_covered(intervals, starts, start, end):
+    # intervals are merged, so [start, end) is covered only if one interval contains it
+    i = bisect.bisect_right(starts, start) - 1
+    return i >= 0 and intervals[i][1] >= end
+
+def plan_downloads(sensors_list, date_list, sensor_log):
+    """
+    Find the windows that still have to be downloaded.
+
+    Parameters:
+
+    sensors_list (list): Sensor indices.
+    date_list (list): Output of create_pa_datelist (newest date first).
+    sensor_log (SensorLog): Download log holding the coverage index.
+
+    Returns:
+
+    A dictionary {sensor: [(start, end), ...]} with the windows (ISO strings, newest first) that are not
+    covered by downloaded data, confirmed no_data ranges or permanent failures. Sensors with nothing
+    left to download are left out. The coverage of all sensors is read in one query; no data file is opened.
+    """
+    
+    windows = [(date_list[i + 1], date_list[i]) for i in range(len(date_list) - 1)]
+    epoch_windows = [(_iso_to_epoch(start), _iso_to_epoch(end)) for start, end in windows]
+    coverage = sensor_log.coverage(sensors_list)
+    
+    plan = {}
+    for sensor in sensors_list:
+        intervals = coverage.get(int(sensor), [])
+        starts = [interval[0] for interval in intervals]
+        missing = [window for window, (start, end) in zip(windows, epoch_windows)
+                   if not _is_covered(intervals, starts, start, end)]
+        if missing:
+            plan[sensor] = missing
+    return plan
+
+# Rules that exclude (sensor-set, time-range) pairs from the download plan
+SKIP_RULES_PATH = 'data/skip_rules.json'
+
+class SkipRules:
+    """
+    Compiled skip rules, applied to a whole download plan before any request is made.
+
+    The config file is a JSON list of rules:
+
+        {"name": "...", "sensors_file": "data/indoor_us_jay.csv", "start": "2021-01-01", "end": "2023-12-31", "reason": "..."}
+
+    `sensors_file` is a CSV with a sensor_index column (or `sensors` lists them inline; with neither, the rule
+    applies to every sensor). A rule removes the windows that end inside [start, end], both dates included.
+    Sensor lists are compiled into hashed sets, and each sensor maps to the time ranges of its rules.
+    """
+
+    def __init__(self, rules):
+        import pandas as pd
+        self.names = [rule["name"] for rule in rules]
+        self.reasons = {rule["name"]: rule.get("reason", rule["name"]) for rule in rules}
+        self.all_sensors = []   # (name, start, end) of rules without a sensor list
+        self.by_sensor = {}     # sensor -> [(name, start, end), ...]
+        for rule in rules:
+            start = _iso_to_epoch(f"{rule['start']}T00:00:00Z")
+            end = _iso_to_epoch(f"{rule['end']}T00:00:00Z") + 86399
+            if "sensors_file" in rule:
+                sensors = set(pd.read_csv(rule["sensors_file"], usecols=["sensor_index"])["sensor_index"].astype(int))
+            elif "sensors" in rule:
+                sensors = set(int(sensor) for sensor in rule["sensors"])
+            else:
+                self.all_sensors.append((rule["name"], start, end))
+                continue
+            for sensor in sensors:
+                self.by_sensor.setdefault(sensor, []).append((rule["name"], start, end))
+
+    @classmethod
+    def from_config(cls, config_path=SKIP_RULES_PATH):
+        """Load the rules from a JSON config file. A missing file means no rules."""
+        if not config_path or not os.path.exists(config_path):
+            return cls([])
+        with open(config_path, 'r') as config_file:
+            return cls(json.load(config_file))
+
+    def apply(self, plan, sensor_log=None, removed_windows=None):
+        """
+        Remove the windows excluded by the rules from a plan made by plan_downloads.
+
+        Returns the reduced plan and the number of windows each rule removed. Sensors that lost
+        windows are marked as skipped in sensor_log, if given. Each removed window is appended to
+        the removed_windows list, if given, as (sensor, start, end, rule name).
+        """
+        removed = {name: 0 for name in self.names}
+        skipped = []
+        result = {}
+        for sensor, windows in plan.items():
+            sensor_rules = self.all_sensors + self.by_sensor.get(int(sensor), [])
+            if not sensor_rules:
+                result[sensor] = windows
+                continue
+            kept = []
+            for window in windows:
+                end = _iso_to_epoch(window[1])
+                rule = next((name for name, start, stop in sensor_rules if start <= end <= stop), None)
+                if rule is None:
+                    kept.append(window)
+                else:
+                    removed[rule] += 1
+                    if removed_windows is not None:
+                        removed_windows.append((sensor, window[0], window[1], rule))
+            if len(kept) < len(windows):
+                skipped.append(sensor)
+            if kept:
+                result[sensor] = kept
+
+        if sensor_log is not None and skipped:
+            sensor_log.mark_skipped_many(skipped)
+        return result, removed
+
+# Largest number of rows returned by one history request
+PA_MAX_ROWS = 720
+
+# Longest window requested for one sensor, in days
+PA_MAX_SPAN_DAYS = 14
+
+def estimate_points(rows, n_fields):
+    """API points of a history request: every row costs the requested fields plus time_stamp, sensor_index and 2 points per row."""
+    return int(rows * (n_fields + 4))
+
+def _rows_per_day(average_time):
+    # Real-time data (average 0) comes about every 2 minutes
+    return 1440 / max(int(average_time), 2)
+
+def subtract_intervals(start, end, intervals):
+    """Parts of [start, end) not covered by the merged, sorted intervals."""
+    gaps = []
+    for interval_start, interval_end in intervals:
+        if interval_end <= start:
+            continue
+        if interval_start >= end:
+            break
+        if interval_start > start:
+            gaps.append((start, interval_start))
+        start = max(start, interval_end)
+    if start < end:
+        gaps.append((start, end))
+    return gaps
+
+def plan_budget(sensors_list, bdate, edate, average_time, sensor_log, points_budget=None,
+                fields=HISTORY_FIELDS, sensors_index=None, skip_rules=None, max_rows=PA_MAX_ROWS,
+                max_span_days=PA_MAX_SPAN_DAYS, requests_per_second=None, removed_windows=None, dry_run=False):
+    """
+    Plan a download with windows sized per sensor, within a budget of API points.
+
+    Parameters:
+
+    sensors_list (list): Sensor indices.
+    bdate, edate (string): Download period ('%Y-%m-%d').
+    average_time (int): The average time (in minutes) of the requested data.
+    sensor_log (SensorLog): Download log with the coverage index and the row counts of downloaded windows.
+    points_budget (int, optional): Largest number of API points to spend (default: no limit).
+    fields (list, optional): Requested fields (default: HISTORY_FIELDS).
+    sensors_index (DataFrame, optional): The sensor index. Windows before date_created or after last_seen are left out.
+    skip_rules (SkipRules, optional): Rules applied to the plan.
+    max_rows (int, optional): Largest number of rows returned by one request (default: 720).
+    max_span_days (int, optional): Longest window in days (default: 14).
+    requests_per_second (float, optional): Request rate used to estimate the wall time.
+    removed_windows (list, optional): Receives (sensor, start, end, reason) for each window left out by the
+        budget (reason "points_budget") or by a skip rule (the rule name).
+    dry_run (bool, optional): Do not mark the sensors that lost windows to a skip rule as skipped in sensor_log.
+
+    Returns:
+
+    The plan {sensor: [(start, end), ...]} (ISO strings, newest first) and a report dictionary.
+
+    Detailed Steps:
+
+    1. The period of each sensor is reduced to the gaps in its coverage index (and to its active period).
+    2. Each sensor's window is the largest span whose expected rows stay under max_rows. The expected
+       rows use the sensor's observed density: rows downloaded / rows possible over its downloaded windows.
+       Sparse sensors therefore get longer windows and fewer requests.
+    3. With a budget, windows are chosen by lowest points per sensor-day, which maximizes the completed
+       sensor-days for the points spent.
+    """
+    import pandas as pd
+    
+    begin = _iso_to_epoch(f"{bdate}T00:00:00Z")
+    end = _iso_to_epoch(f"{edate}T00:00:00Z")
+    rows_per_day = _rows_per_day(average_time)
+    coverage = sensor_log.coverage(sensors_list)
+    densities = sensor_log.densities(average_time)
+    
+    active = {}
+    if sensors_index is not None:
+        for sensor, created, seen in sensors_index[['sensor_index', 'date_created', 'last_seen']].itertuples(index=False):
+            created = pd.Timestamp(created, tz='UTC') if pd.notna(created) else None
+            seen = pd.Timestamp(seen, tz='UTC') if pd.notna(seen) else None
+            active[int(sensor)] = (int(created.timestamp()) - int(created.timestamp()) % 86400 if created else begin,
+                                   int(seen.timestamp()) - int(seen.timestamp()) % 86400 + 86400 if seen else end)
+    
+    # Candidate windows: (points per sensor-day, sensor, start, end, points, days)
+    candidates = []
+    for sensor in sensors_list:
+        sensor_begin, sensor_end = active.get(int(sensor), (begin, end))
+        sensor_begin, sensor_end = max(begin, sensor_begin), min(end, sensor_end)
+        if sensor_begin >= sensor_end:
+            continue
         
-        print("CHECK POINT 2:")
-        print(hist_api_url)
-                
-        # Generate date list for all sensors
-        date_list = create_pa_datelist(average_time, bdate, edate)
+        density = densities.get(int(sensor), 1.0)
+        span_days = int(min(max_span_days, max(1, max_rows // (rows_per_day * density))))
+        expected_rows = min(max_rows, span_days * rows_per_day * density)
         
-        print("CHECK POINT 2: Generated Date List")
-        print(date_list)
+        for gap_start, gap_end in subtract_intervals(sensor_begin, sensor_end, coverage.get(int(sensor), [])):
+            window_end = gap_end
+            while window_end > gap_start:
+                window_start = max(gap_start, window_end - span_days * 86400)
+                days = (window_end - window_start) / 86400
+                points = estimate_points(min(expected_rows, days * rows_per_day * density), len(fields))
+                candidates.append((points / days, sensor, window_start, window_end, points, days))
+                window_end = window_start
+    
+    # Choose the windows with the most sensor-days per point until the budget is spent
+    selected = []
+    spent = 0
+    for candidate in sorted(candidates, key=lambda candidate: candidate[0]):
+        if points_budget is not None and spent + candidate[4] > points_budget:
+            if removed_windows is not None:
+                removed_windows.append((candidate[1], _epoch_to_iso(candidate[2]), _epoch_to_iso(candidate[3]),
+                                        "points_budget"))
+            continue
+        selected.append(candidate)
+        spent += candidate[4]
+    
+    plan = {}
+    for _, sensor, window_start, window_end, _, _ in sorted(selected, key=lambda candidate: (candidate[1], -candidate[3])):
+        plan.setdefault(sensor, []).append((_epoch_to_iso(window_start), _epoch_to_iso(window_end)))
+    plan = {sensor: plan[sensor] for sensor in sensors_list if sensor in plan}
+    
+    removed = {}
+    if skip_rules is not None:
+        plan, removed = skip_rules.apply(plan, None if dry_run else sensor_log, removed_windows)
+    
+    # Report on the windows that are left
+    kept = {(sensor, start, end) for sensor, windows in plan.items() for start, end in windows}
+    kept_candidates = [candidate for candidate in selected
+                       if (candidate[1], _epoch_to_iso(candidate[2]), _epoch_to_iso(candidate[3])) in kept]
+    n_requests = len(kept_candidates)
+    report = {
+        "sensors": len(plan),
+        "requests": n_requests,
+        "estimated_points": sum(candidate[4] for candidate in kept_candidates),
+        "sensor_days": round(sum(candidate[5] for candidate in kept_candidates), 1),
+        "points_budget": points_budget,
+        "windows_over_budget": len(candidates) - len(selected),
+        "skipped_windows": removed,
+        "estimated_seconds": round(n_requests / requests_per_second, 1) if requests_per_second else None
+    }
+    return plan, report
+
+def plan_report(plan, average_time, sensor_log=None, skipped_windows=None, fields=HISTORY_FIELDS,
+                max_rows=PA_MAX_ROWS, requests_per_second=None):
+    """
+    The report of plan_budget for a plan made by plan_downloads (and SkipRules.apply): one request per window,
+    and the points estimated from the rows each window is expected to return (the observed density of its
+    sensor in sensor_log, at most max_rows).
+    """
+    rows_per_day = _rows_per_day(average_time)
+    densities = sensor_log.densities(average_time) if sensor_log is not None else {}
+    n_requests, points, sensor_days = 0, 0, 0.0
+    for sensor, windows in plan.items():
+        density = densities.get(int(sensor), 1.0)
+        for start, end in windows:
+            days = (_iso_to_epoch(end) - _iso_to_epoch(start)) / 86400
+            n_requests += 1
+            points += estimate_points(min(max_rows, days * rows_per_day * density), len(fields))
+            sensor_days += days
+    return {
+        "sensors": len(plan),
+        "requests": n_requests,
+        "estimated_points": points,
+        "sensor_days": round(sensor_days, 1),
+        "points_budget": None,
+        "windows_over_budget": 0,
+        "skipped_windows": skipped_windows or {},
+        "estimated_seconds": round(n_requests / requests_per_second, 1) if requests_per_second else None
+    }
+
+def print_plan_report(report):
+    """Print the dry-run report of plan_budget or plan_report."""
+    print(f"Sensors to download: {report['sensors']}")
+    print(f"Requests: {report['requests']}")
+    print(f"Estimated points: {report['estimated_points']}" +
+          (f" (budget: {report['points_budget']})" if report['points_budget'] is not None else ""))
+    print(f"Sensor-days: {report['sensor_days']}")
+    print(f"Windows left out by the budget: {report['windows_over_budget']}")
+    for name, n_windows in report['skipped_windows'].items():
+        print(f"Windows removed by skip rule {name}: {n_windows}")
+    if report['estimated_seconds'] is not None:
+        print(f"Estimated wall time: {timedelta(seconds=round(report['estimated_seconds']))}")
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by all download workers.
 
-        len_datelist = len(date_list) - 1
+    Every request sent to the PurpleAir API takes one token. Tokens are refilled at
+    `rate` per second up to `capacity`, so the combined request rate of all workers
+    never exceeds `rate` (after an initial burst of at most `capacity` requests).
+    Windows that are skipped never take a token and therefore never wait.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# HTTP statuses that stop the whole run (bad or missing key, no API points left)
+RUN_ERROR_STATUSES = (401, 402, 403)
+
+# HTTP statuses recorded as "failed" coverage of the sensor, never planned again (see SensorLog.clear_failed)
+PERMANENT_ERROR_STATUSES = (404,)
+
+def _download_sensor(sensor, windows, hist_api_url, average_api, fields_api_url, store,
+                     sensor_log, stats_lock, bucket, stats, stop_event, transport, instrumentation):
+    """Download the planned windows of one sensor. Windows of a sensor run in order, one at a time."""
+    import pyarrow.compute as pc
+    
+    partitions = set()
+    
+    # Create start and end date API URL
+    for position, (start, date) in enumerate(windows):
         
+        # Stop if another worker ran out of API points
+        if stop_event.is_set():
+            instrumentation.event("window", sensor=int(sensor), start=start, end=date, outcome="stopped")
+            continue
         
-        # Create start and end date API URL
-        for index, date in enumerate(date_list):
-            
-            # Throttle API requests
-            time.sleep(sleep_seconds)  
-            
-            if index < len_datelist:
-                
-                # Check if any file exists for this sensor
-                # existing_files = glob.glob(f'{sensor_folder}/*.csv')
-                
-                existing_files = glob.glob(f'{data_folder}/sensorID_{sensor}_*csv')
-
-                # If file exists, read the existing data and get the date range
-                if existing_files:
-                    existing_df = pd.read_csv(existing_files[0])
-                    existing_mindate = pd.to_datetime(existing_df['time_stamp'].min()).strftime('%Y-%m-%dT%H:%M:%SZ')
-                    existing_maxdate = (pd.to_datetime(existing_df['time_stamp'].max()) + pd.Timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        # Download data for PA
+        print(f'Downloading for PA: {sensor} for Dates: {start} and {date}.')
+        dates_api_url = f'&start_timestamp={start}&end_timestamp={date}'
+        
+        api_url = hist_api_url + dates_api_url + average_api + fields_api_url
+        
+        # One structured event per window
+        event = {"sensor": int(sensor), "start": start, "end": date}
+        
+        try:
+            # Windows already in the response cache cost no request and do not wait for the rate limit
+            stage_start = time.perf_counter()
+            with instrumentation.profile("network"):
+                response = transport.cached(api_url)
+                if response is not None:
+                    event["cached"] = True
+                    with stats_lock:
+                        stats["cached"] += 1
+                elif transport.replay_only:
+                    response = None
                 else:
-                    existing_df = pd.DataFrame()
-                    existing_mindate, existing_maxdate = None, None
-                
-                print("CHECK POINT 3: Existing Files")
-                print(existing_files)
-                
-                # Skip if the date is between the already downloaded date range
-                if existing_mindate and existing_maxdate and (existing_mindate < date < existing_maxdate):
-                    print(f"Skipping {sensor} data for date {date}: already downloaded.")
-                    continue
-                               
-                # Skip if sensor is in us_indoor and the date is in 2021-2023
-                if sensor in us_indoor_sensorlist_jay and min(check_datelist) <= date <= max(check_datelist):
-                    # Add sensor to skipped list if not already present
-                    if sensor not in log_data["sensors_skipped"]:
-                        log_data["sensors_skipped"].append(sensor)
-                    print(f"Skipping download for {sensor} from {date_list[index+1]} to {date} (us_indoor sensor already downloaded)")
-                    continue
-                
-                # Download data for PA
-                print(f'Downloading for PA: {sensor} for Dates: {date_list[index+1]} and {date}.')
-                dates_api_url = f'&start_timestamp={date_list[index+1]}&end_timestamp={date}'
-                
-                api_url = hist_api_url + dates_api_url + average_api + fields_api_url
-                                    
+                    # Throttle API requests: all workers share one rate limit
+                    if bucket is not None:
+                        bucket.acquire()
+                    with stats_lock:
+                        stats["requests"] += 1
+                    response = transport.get(api_url)
+            if response is None:
+                print(f"Not in the cache for sensor {sensor} from {start} to {date} (replay-only mode)")
+                instrumentation.event("window", outcome="skipped", skip_reason="not_in_cache", **event)
+                continue
+            network_seconds = time.perf_counter() - stage_start
+            event.update(status=response.status_code, latency_seconds=round(network_seconds, 6),
+                         bytes=len(response.content))
+            response.raise_for_status()  # Raises an exception for 4xx/5xx responses
+            
+            stage_start = time.perf_counter()
+            with instrumentation.profile("parse"):
+                table = decode_history(response.content)
+            parse_seconds = time.perf_counter() - stage_start
+            event["parse_seconds"] = round(parse_seconds, 6)
+            with stats_lock:
+                stats["network_seconds"] += network_seconds
+                stats["parse_seconds"] += parse_seconds
+        
+        except requests.exceptions.HTTPError as e:
+            # A rejected key or no API points left fails every window of the run, not this sensor: stop all workers
+            if response.status_code in RUN_ERROR_STATUSES:
                 try:
-                    response = requests.get(api_url)
-                    response.raise_for_status()  # Raises an exception for 4xx/5xx responses
-                    df = pd.read_csv(StringIO(response.text), sep=",", header=0)
-                
-                except requests.exceptions.HTTPError as e:
-                    print(f"HTTP error for sensor {sensor}: {e}")
-                    log_data[str(sensor)]["url_issue"].append(f"HTTP error: {e}")
-                    break
-                
-                except requests.exceptions.RequestException as e:
-                    try:
-                        json_data = json.loads(response.content)
-                        if json_data["description"] == "Payment is required to make this api call.":
-                            print(json_data["description"])
-                            break
-                        else: 
-                            log_data[str(sensor)]["url_issue"].append(json_data["description"])
-                    except:
-                        log_data[str(sensor)]["url_issue"].append(f"Request failed: {str(e)}")
-                    continue
-                                
-                except Exception as e:
-                    print(f"Unexpected error for sensor {sensor}: {e} during downloading dates from {date_list[index+1]} to {date}")
-                    continue
-                
-                except pd.errors.EmptyDataError:
-                    message = f"{date_list[index+1]} to {date}"
-                    if message not in log_data[str(sensor)]["no_data"]: 
-                        log_data[str(sensor)]["no_data"].append(message)
-                    continue
-                    
-                if df.empty:
-                    message = f"{date_list[index+1]} to {date}"
-                    if message not in log_data[str(sensor)]["no_data"]: 
-                        log_data[str(sensor)]["no_data"].append(message)
-                    continue
+                    print(json.loads(response.content)["description"])
+                except Exception:
+                    print(f"HTTP error: {redact(e)}")
+                outcome = "payment_required" if response.status_code == 402 else "auth_error"
+                instrumentation.event("window", outcome=outcome, **event)
+                stop_event.set()
+                break
+            print(f"HTTP error for sensor {sensor}: {redact(e)}")
+            sensor_log.add_url_issue(sensor, f"HTTP error: {redact(e)}")
+            instrumentation.event("window", outcome="http_error", **event)
+            with stats_lock:
+                stats["errors"] += 1
+            # Only a sensor the API does not know is permanent: every window left for it fails the same way.
+            # Other errors are planned again on the next run
+            if response.status_code in PERMANENT_ERROR_STATUSES:
+                for failed_start, failed_end in windows[position:]:
+                    sensor_log.add_coverage(sensor, "failed", failed_start, failed_end)
+            break
+        
+        except requests.exceptions.RequestException as e:
+            sensor_log.add_url_issue(sensor, f"Request failed: {redact(e)}")
+            instrumentation.event("window", outcome="request_error", error=redact(e), **event)
+            with stats_lock:
+                stats["errors"] += 1
+            continue
+        
+        except Exception as e:
+            print(f"Unexpected error for sensor {sensor}: {redact(e)} during downloading dates from {start} to {date}")
+            instrumentation.event("window", outcome="error", error=redact(e), **event)
+            with stats_lock:
+                stats["errors"] += 1
+            continue
+            
+        event["rows"] = table.num_rows
+        if table.num_rows == 0:
+            sensor_log.add_no_data(sensor, f"{start} to {date}")
+            instrumentation.event("window", outcome="no_data", **event)
+            continue
+        
+        with stats_lock:
+            stats["rows"] += table.num_rows
 
-                
-                # Process DataFrame
-                # warning is silenced: https://pandas.pydata.org/docs/reference/api/pandas.to_datetime.html
-                df['time_stamp'] = pd.to_datetime(df['time_stamp'], utc = True)
-                df = df.drop_duplicates().sort_values(by='time_stamp')
-
-                # Append the new data to the existing DataFrame if it exists
-                if not existing_df.empty:
-                    df = pd.concat([existing_df, df], ignore_index=True)
-                    df['time_stamp'] = pd.to_datetime(df['time_stamp'], utc = True)
-                    df = df.drop_duplicates().sort_values(by='time_stamp')
-
-                # Get the minimum and maximum date from the combined DataFrame
-                min_date = df['time_stamp'].min()
-                max_date = df['time_stamp'].max()
-                
-                min_date = min_date.strftime("%Y_%m_%d")
-                max_date = max_date.strftime("%Y_%m_%d")
-                
-                # Update log for the sensor: min nad max date 
-                log_data[str(sensor)]["min_date"] = min_date
-                log_data[str(sensor)]["max_date"] = max_date
-                
-                try: 
-                    # Save the dataframe
-                    csv_file = f'{data_folder}/sensorID_{sensor}_{min_date}_{max_date}.csv'
-
-                    df.to_csv(csv_file, index=False)
-                    print(f"Attempting to save data to: {csv_file}")
-
-                    # If saving succeeds, remove the old file
-                    if existing_files:
-                        try:
-                            os.remove(existing_files[0])
-                        except Exception as e:
-                            print(f"Error removing old file {existing_files[0]}: {e}")
-                    
-                    print(f"Data is saved to: {csv_file}")
-                    
-                except Exception as e:
-                    print(f"Error saving new file: {e}")
+        try:
+            # Append the window to the store: existing data is never re-read
+            stage_start = time.perf_counter()
+            with instrumentation.profile("write"):
+                partitions.update(store.append(table))
+            write_seconds = time.perf_counter() - stage_start
+            event["write_seconds"] = round(write_seconds, 6)
+            with stats_lock:
+                stats["write_seconds"] += write_seconds
+            print(f"Data is saved to: {store.root}/sensorID_{sensor}")
+        except Exception as e:
+            print(f"Error saving new data: {e}")
+            instrumentation.event("window", outcome="write_error", error=str(e), **event)
+            continue
+
+        # Update log for the sensor: min and max date, and the window is now covered
+        min_max = pc.min_max(table['time_stamp']).as_py()
+        sensor_log.extend_dates(sensor, _epoch_to_iso(min_max['min'])[:10].replace('-', '_'),
+                                _epoch_to_iso(min_max['max'])[:10].replace('-', '_'))
+        sensor_log.add_coverage(sensor, "data", start, date)
+        sensor_log.add_rows(sensor, table.num_rows, _iso_to_epoch(date) - _iso_to_epoch(start))
+        instrumentation.event("window", outcome="data", **event)
+    
+    return partitions
+
+def _timed_compact(store, sensor, month, stats, stats_lock, instrumentation):
+    # Compaction is the merge stage of a download
+    stage_start = time.perf_counter()
+    with instrumentation.profile("merge"):
+        store.compact_partition(sensor, month)
+    merge_seconds = time.perf_counter() - stage_start
+    with stats_lock:
+        stats["merge_seconds"] += merge_seconds
+    instrumentation.event("merge", sensor=int(sensor), month=month, merge_seconds=round(merge_seconds, 6))
+
+def get_historicaldata(sensors_list, 
+                       bdate, 
+                       edate, 
+                       average_time, 
+                       key_read, 
+                       sleep_seconds,
+                       download_dir = "processed",
+                       max_workers = 1,
+                       requests_per_second = None,
+                       log_file_path = LOG_FILE_PATH,
+                       skip_rules_path = SKIP_RULES_PATH,
+                       transport = None,
+                       points_budget = None,
+                       adaptive_windows = False,
+                       dry_run = False,
+                       instrumentation = None,
+                       migrate_csv = True):
+    """
+    Purpose:
+
+    This function downloads historical sensor data from the PurpleAir API for a given list of sensors over a specified date range. It processes the data, stores it in separate files per sensor, and updates a log to track downloaded data.
+
+    Parameters:
+
+    sensors_list (list): List of sensor indices to download data for.
+    bdate (string): The beginning date (in ISO format) for the data to be retrieved.
+    edate (string): The ending date (in ISO format) for the data to be retrieved.
+    average_time (int): The average time (in minutes) used for the sensor data.
+    key_read (string): API key to access PurpleAir API.
+    sleep_seconds (int): Minimum time in seconds between consecutive API requests to avoid throttling. Only used when requests_per_second is not given.
+    max_workers (int, optional): Number of sensors downloaded concurrently (default: 1).
+    requests_per_second (float, optional): Request rate shared by all workers (default: 1 / sleep_seconds).
+    log_file_path (string, optional): SQLite download log (default: "sensor_log.sqlite"). The old sensor_log.json is imported the first time.
+    skip_rules_path (string, optional): JSON file of rules that exclude sensors and time ranges from the download (default: "data/skip_rules.json").
+    transport (PurpleAirTransport, optional): HTTP transport with the response cache and retries (default: get_transport()). Windows found in the cache are not requested again.
+    points_budget (int, optional): Largest number of API points to spend. Implies adaptive_windows.
+    adaptive_windows (bool, optional): Plan with plan_budget: windows sized per sensor from its observed density instead of the fixed create_pa_datelist windows (default: False).
+    dry_run (bool, optional): Print the report of the plan the download would use (estimated points and wall time; plan_budget with adaptive_windows or points_budget, else plan_report) and return it without downloading or writing anything: the log is only read, CSV files of earlier versions are not migrated and no sensor is marked as skipped (default: False).
+    instrumentation (Instrumentation, optional): Receives one event per planned window (downloaded, cached, empty, failed or skipped with its reason) and per compacted partition, and a "run" event with the stats. Its metrics file and stage profiles are written at the end of the run (default: events are only counted in memory).
+    migrate_csv (bool, optional): Move the CSV files of earlier versions into the Parquet store first (default: True). run_shard turns it off: the shards of an array share the store.
+    
+    Returns:
+    
+    Save Data: Each downloaded window is appended to the Parquet store in pair_data/sensorID_{sensor}/{YYYY-MM}/, and the chunks of a sensor are compacted once it finishes.
+    Log Updates: After processing each window, the log file is updated with information about skipped sensors, missing data, and any errors encountered.
+    Stats: A dictionary with the number of windows removed by each skip rule, the number of windows read from the response cache, the number of requests, rows and failed windows, the seconds spent in the network, parse, merge (compaction) and write stages summed over workers, the elapsed seconds, the throughput in requests/s and rows/s, whether the run stopped early for lack of API points or a rejected API key, and the (sensor, month) partitions written ("partitions", for run_qa and update_rollups).
+
+    """
+    import pandas as pd
+    
+    # Open the download log: every window is committed as soon as it finishes.
+    # A dry run reads it without writing anything, not even a new or upgraded log file
+    sensor_log = open_sensor_log(log_file_path, read_only=dry_run)
+    
+    # Historical API URL: for multiple sensors
+    root_api_url = API_ROOT_URL
+    
+    # Average time parameter for API
+    average_api = f'&average={average_time}'
+    
+    # Create the fields API URL
+    fields_api_url = '&fields=' + '%2C'.join(HISTORY_FIELDS)
+    
+    # Generate date list for all sensors
+    date_list = create_pa_datelist(average_time, bdate, edate)
+    
+    # Structured events and metrics of the run
+    instrumentation = instrumentation or Instrumentation()
+    
+    # One rate limit shared by all workers
+    if requests_per_second is None and sleep_seconds:
+        requests_per_second = 1 / sleep_seconds
+    
+    # Rules that exclude windows, e.g. us_indoor sensors that are already downloaded
+    skip_rules = SkipRules.from_config(skip_rules_path)
+    
+    # A dry run builds the same plan as the download it estimates, and reports on it
+    removed_windows = []
+    if adaptive_windows or points_budget is not None:
+        # Windows sized per sensor and chosen within the points budget
+        index_path = os.path.join(download_dir, "sensors_index.csv")
+        sensors_index = pd.read_csv(index_path) if os.path.exists(index_path) else None
+        plan, report = plan_budget(sensors_list, bdate, edate, average_time, sensor_log, points_budget=points_budget,
+                                   sensors_index=sensors_index, skip_rules=skip_rules,
+                                   requests_per_second=requests_per_second, removed_windows=removed_windows,
+                                   dry_run=dry_run)
+        removed = report["skipped_windows"]
+        print_plan_report(report)
+    else:
+        # Only the windows missing from the coverage index are downloaded
+        plan = plan_downloads(sensors_list, date_list, sensor_log)
+        plan, removed = skip_rules.apply(plan, None if dry_run else sensor_log, removed_windows)
+        if dry_run:
+            report = plan_report(plan, average_time, sensor_log, skipped_windows=removed,
+                                 requests_per_second=requests_per_second)
+            print_plan_report(report)
+    if dry_run:
+        sensor_log.close()
+        return report
+    
+    for sensor, start, end, reason in removed_windows:
+        instrumentation.event("window", sensor=int(sensor), start=start, end=end, outcome="skipped", skip_reason=reason)
+    for name, n_windows in removed.items():
+        print(f"Skip rule {name} ({skip_rules.reasons[name]}): {n_windows} windows removed")
+    print(f"{sum(len(windows) for windows in plan.values())} windows to download for {len(plan)} of {len(sensors_list)} sensors")
+    
+    # Data store: CSV files from earlier runs are moved into it first
+    store = migrate_csv_history(download_dir) if migrate_csv else HistoryStore(download_dir)
+    
+    # Ensure every sensor exists in the log
+    sensor_log.add_sensors(sensors_list)
+    
+    bucket = TokenBucket(requests_per_second) if requests_per_second else None
+    
+    # One pooled session and response cache shared by all workers
+    transport = transport or get_transport()
+    
+    stats_lock = threading.Lock()
+    stop_event = threading.Event()
+    stats = {"skipped_windows": removed, "cached": 0, "requests": 0, "rows": 0, "errors": 0,
+             "network_seconds": 0.0, "parse_seconds": 0.0, "merge_seconds": 0.0, "write_seconds": 0.0}
+    partitions = set()
+    start_time = time.monotonic()
+    
+    # Process each sensor: up to max_workers sensors are downloaded at the same time,
+    # and the chunks of finished sensors are compacted in the background
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, ThreadPoolExecutor(max_workers=1) as compactor:
+        futures = {}
+        for sensor, windows in plan.items():
+            hist_api_url = root_api_url + f'{sensor}/history/csv?api_key={key_read}'
+            future = executor.submit(_download_sensor, sensor, windows, hist_api_url, average_api, fields_api_url,
+                                     store, sensor_log, stats_lock, bucket, stats, stop_event, transport,
+                                     instrumentation)
+            futures[future] = sensor
+        
+        compactions = {}
+        for future in as_completed(futures):
+            try:
+                for sensor, month in future.result():
+                    partitions.add((int(sensor), month))
+                    compaction = compactor.submit(_timed_compact, store, sensor, month, stats, stats_lock,
+                                                  instrumentation)
+                    compactions[compaction] = (sensor, month)
+            except Exception as e:
+                print(f"Unexpected error for sensor {futures[future]}: {redact(e)}")
+        
+        # A partition that failed to compact keeps its chunks: readers still see all rows
+        for compaction in as_completed(compactions):
+            try:
+                compaction.result()
+            except Exception as e:
+                sensor, month = compactions[compaction]
+                print(f"Compaction failed for sensor {sensor}, {month}: {redact(e)}")
+                instrumentation.event("merge", sensor=int(sensor), month=month, outcome="failed",
+                                      error=redact(e))
+    
+    # Throughput of the run
+    elapsed = time.monotonic() - start_time
+    stats["seconds"] = round(elapsed, 3)
+    stats["requests_per_second"] = round(stats["requests"] / elapsed, 3) if elapsed > 0 else 0.0
+    stats["rows_per_second"] = round(stats["rows"] / elapsed, 3) if elapsed > 0 else 0.0
+    stats["stopped"] = stop_event.is_set()
+    for stage in ["network_seconds", "parse_seconds", "merge_seconds", "write_seconds"]:
+        stats[stage] = round(stats[stage], 3)
+    print(f"{stats['requests']} requests, {stats['rows']} rows in {stats['seconds']} s: "
+          f"{stats['requests_per_second']} requests/s, {stats['rows_per_second']} rows/s")
+    instrumentation.event("run", stats=stats)
+    instrumentation.flush()
+    # Added after the run event, which would otherwise list every partition
+    stats["partitions"] = sorted(partitions)
                     
-    # Save the updated log file at the end of the process
-    with open(log_file_path, 'w') as log_file:
-        json.dump(log_data, log_file, indent=4)
+    sensor_log.close()
+    print(f"Log file updated: {log_file_path}")
+    
+    return stats
 
-    print(f"Log file saved and updated: {log_file_path}")
+# Per-shard download logs of a sharded (SLURM array) run
+SHARD_DIR = 'state'
 
-def main():
-    # API Keys provided by PurpleAir(c)
-    key_read = 'AB2FB9C8-714F-11EF-95CB-42010A80000E'
+def shard_sensors(sensors_list, n_shards, shard_id):
+    """Deterministic partition of a sensor list: shard i gets the sensors with sensor_index % n_shards == i, in sorted order."""
+    return sorted(sensor for sensor in sensors_list if int(sensor) % n_shards == shard_id)
 
-    # Sleep Seconds
-    sleep_seconds = 3  # wait sleep_seconds after each query
+def shard_log_path(n_shards, shard_id, shard_dir=SHARD_DIR):
+    return os.path.join(shard_dir, f"shard_{shard_id:04d}_of_{n_shards:04d}.sqlite")
 
-    # Data download period. Enter Start and end Dates
-    bdate = '2021-01-01'
-    edate = '2021-01-15'
+def run_shard(key_read, sensors_list, bdate, edate, average_time, n_shards, shard_id, requests_per_second,
+              download_dir="processed", log_file_path=LOG_FILE_PATH, shard_dir=SHARD_DIR, **kwargs):
+    """
+    Download one shard of a sensor list, e.g. one task of a SLURM job array.
 
-    # Average_time. The desired average in minutes
-    average_time = 10  # or 10 or 0 (Current script is set only for real-time, 10, or 60 minutes data)
+    The shard gets its own log in shard_dir, seeded with the state of its sensors from the global log,
+    and 1/n_shards of the request rate. Its data goes to the shared store: sensors are partitioned, so
+    shards never write the same partition. The log records the shard status: "running", "done", or
+    "failed" when a window failed or the API points ran out. A shard resumed before the merge downloads
+    only what its log still misses. merge_shard_logs reconciles the shard logs into the global log and
+    archives them, so the next run of a shard is seeded again from the global log, and failed_shards lists
+    the shards to run again. CSV files of earlier versions are not migrated here: the shards share the store,
+    so run `purple_air.py prepare` once before the array. Other keyword arguments are passed to get_historicaldata.
+
+    Returns the stats of get_historicaldata.
+    """
     
-    # data folder directory
-    download_dir = "processed"
+    shard = shard_sensors(sensors_list, n_shards, shard_id)
+    shard_log_file = shard_log_path(n_shards, shard_id, shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
     
+    # Start from the global state of the shard's sensors (a shard resumed before the merge keeps its own log)
+    with SensorLog(shard_log_file) as shard_log:
+        if shard_log.get_meta("shard_status") is None and os.path.exists(log_file_path):
+            SensorLog(log_file_path).close()  # brings an older global log up to the current tables
+            shard_log.copy_sensors_from(log_file_path, shard)
+        shard_log.set_meta("shard_status", "running")
+        shard_log.set_meta("shard_sensors", len(shard))
+    
+    print(f"Shard {shard_id} of {n_shards}: {len(shard)} sensors, {requests_per_second / n_shards:.3f} requests/s")
+    
+    status = "failed"
     try:
-        # get sensors
-        sensorslist_dict = get_sensorslist(key_read=key_read, filename="sensors_index", download_dir=download_dir)
-        # us_indoor_sensorlist = sensorslist_dict["us_indoor"]
-        # us_outdoor_sensorlist = sensorslist_dict["us_outdoor"]
-        nonus_sensorlist = sensorslist_dict["non_us"]
+        stats = get_historicaldata(shard, bdate, edate, average_time, key_read, sleep_seconds=None,
+                                   download_dir=download_dir, requests_per_second=requests_per_second / n_shards,
+                                   log_file_path=shard_log_file, migrate_csv=False, **kwargs)
+        if not stats.get("stopped") and not stats.get("errors"):
+            status = "done"
+        return stats
+    finally:
+        with SensorLog(shard_log_file) as shard_log:
+            shard_log.set_meta("shard_status", status)
+        print(f"Shard {shard_id} of {n_shards}: {status}")
+
+def shard_archive_path(n_shards, shard_id, shard_dir=SHARD_DIR):
+    """Where merge_shard_logs moves a shard log once it is merged: the latest merged log of each shard."""
+    return os.path.join(shard_dir, "merged", os.path.basename(shard_log_path(n_shards, shard_id, shard_dir)))
+
+def failed_shards(n_shards, shard_dir=SHARD_DIR):
+    """Shards that did not finish: no log, still running or failed (the log not merged yet, else the archived one)."""
+    failed = []
+    for shard_id in range(n_shards):
+        path = shard_log_path(n_shards, shard_id, shard_dir)
+        if not os.path.exists(path):
+            path = shard_archive_path(n_shards, shard_id, shard_dir)
+        if not os.path.exists(path):
+            failed.append(shard_id)
+            continue
+        with SensorLog(path) as shard_log:
+            if shard_log.get_meta("shard_status") != "done":
+                failed.append(shard_id)
+    return failed
+
+def merge_shard_logs(n_shards, log_file_path=LOG_FILE_PATH, shard_dir=SHARD_DIR):
+    """
+    Reconcile the shard logs into the global log.
+
+    The entries of each shard's sensors in the global log are replaced by the shard's entries (a shard log
+    starts from the global state, so it holds everything the global log had for its sensors). Returns the
+    shards that are not done; they are merged too, so the global log keeps their partial progress.
+
+    Merged shard logs are moved to shard_archive_path: the next run of a shard starts again from the global
+    log, with the progress made since, and a later merge never brings back the state of an old run.
+    """
+    
+    merged = []
+    with open_sensor_log(log_file_path) as sensor_log:
+        for shard_id in range(n_shards):
+            path = shard_log_path(n_shards, shard_id, shard_dir)
+            if os.path.exists(path):
+                sensor_log.copy_sensors_from(path)
+                merged.append(shard_id)
+                print(f"Merged {path}")
+    
+    for shard_id in merged:
+        path = shard_log_path(n_shards, shard_id, shard_dir)
+        archive_path = shard_archive_path(n_shards, shard_id, shard_dir)
+        os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(path + suffix):
+                os.replace(path + suffix, archive_path + suffix)
+            elif os.path.exists(archive_path + suffix):
+                os.remove(archive_path + suffix)
+    
+    failed = failed_shards(n_shards, shard_dir)
+    if failed:
+        print(f"Shards to run again: {','.join(str(shard_id) for shard_id in failed)}")
+    return failed
+
+# Sensors per request of the live ingestion: the show_only list is part of the request URL
+LIVE_BATCH_SIZE = 500
+
+# Histogram buckets of the data lag of live readings, in seconds
+LAG_BUCKETS = (60, 120, 300, 600, 900, 1800, 3600, 7200, 21600, 86400)
+
+class LiveIngest:
+    """
+    Long-running ingestion of the latest readings of many sensors.
+
+    Every interval seconds, the sensors are requested from the sensor list endpoint used by get_sensors,
+    batch_size sensors per request (show_only), with the fields of get_historicaldata and last_seen. Each
+    reading is stored with last_seen as its time stamp. A reading whose (sensor_index, time_stamp) is already
+    stored is dropped, so polling faster than the sensors report adds no rows; the latest stored time stamp of
+    each sensor is read from the Parquet statistics at start, so a restart adds no duplicates either.
+
+    New rows are buffered and appended to their own HistoryStore (download_dir/pair_live/) every flush_seconds,
+    or as soon as flush_rows rows are buffered; a partition is compacted once it holds compact_chunks chunks.
+    Memory therefore stays bounded by the sensor list (one time stamp per sensor) and flush_rows, however long the ingestion runs. Requests take a
+    token of a TokenBucket (requests_per_second); a cycle that takes longer than interval is followed by the next
+    one right away, without catching up the cycles it overran.
+
+    Lag metrics, written to the instrumentation's metrics file after every cycle: the lag of every new reading
+    (poll time - last_seen) in the purpleair_live_lag_seconds histogram, and gauges of the last cycle (duration,
+    maximum and median lag, sensors with a new reading, API data lag, buffered rows, last cycle time).
+
+    Live readings are the current values of the sensors, not averages: they are kept out of pair_data/, so the
+    download, QA and rollups never mix them with the averaged history (read them with
+    load_history(store_name=LIVE_STORE)). They are not added to the coverage of the download log either.
+    """
+
+    def __init__(self, key_read, sensors_list, interval=120, batch_size=LIVE_BATCH_SIZE, requests_per_second=1,
+                 download_dir="processed", flush_seconds=900, flush_rows=100_000, compact_chunks=24,
+                 transport=None, instrumentation=None):
+        self.key_read = key_read
+        self.sensors = sorted(set(int(sensor) for sensor in sensors_list))
+        self.interval = interval
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.flush_rows = flush_rows
+        self.compact_chunks = compact_chunks
+        self.bucket = TokenBucket(requests_per_second)
+        self.transport = transport or get_transport()
+        self.instrumentation = instrumentation or Instrumentation()
+        self.store = HistoryStore(download_dir, LIVE_STORE)
+        self.stop_event = threading.Event()
+        self.fields_api_url = '&fields=' + '%2C'.join(['last_seen'] + HISTORY_FIELDS)
+
+        self.latest = self._latest_time_stamps()   # sensor -> latest stored time stamp
+        self.buffer = []                           # tables of new rows, not yet appended to the store
+        self.buffered_rows = 0
+        self.last_flush = time.monotonic()
+        self.cycles = 0
+
+    def _latest_time_stamps(self):
+        import pyarrow.parquet as pq
+        # Maximum time stamp of the last month of each sensor, from the row group statistics (no data is read)
+        latest = {}
+        for sensor in self.sensors:
+            months = self.store.months(sensor)
+            if not months:
+                continue
+            for file in self.store.partition_files(sensor, months[-1]):
+                metadata = pq.read_metadata(file)
+                column = metadata.schema.names.index('time_stamp')
+                for row_group in range(metadata.num_row_groups):
+                    statistics = metadata.row_group(row_group).column(column).statistics
+                    if statistics is not None and statistics.has_min_max:
+                        latest[sensor] = max(latest.get(sensor, statistics.max), statistics.max)
+        return latest
+
+    def _decode(self, json_data):
+        import pyarrow as pa
+        # Rows of the sensor list response -> table with HISTORY_SCHEMA, time stamped with last_seen
+        n_rows = len(json_data["data"])
+        columns = dict(zip(json_data["fields"], zip(*json_data["data"]))) if n_rows else {}
+        return pa.table([pa.array(columns.get('last_seen' if name == 'time_stamp' else name, [None] * n_rows),
+                                  type=history_schema().field(name).type) for name in history_schema().names],
+                        schema=history_schema())
+
+    def poll_batch(self, batch):
+        """
+        Request the current readings of a batch of sensors and buffer the new ones.
+
+        Returns the lags (seconds since last_seen) of the new readings, or None when the request failed.
+        """
+        import pyarrow as pa
+        api_url = API_ROOT_URL + f'?api_key={self.key_read}' + self.fields_api_url + \
+                  '&show_only=' + '%2C'.join(str(sensor) for sensor in batch)
+        event = dict(url=redact(api_url), sensors=len(batch))
+
+        self.bucket.acquire()
+        request_start = time.perf_counter()
+        try:
+            with self.instrumentation.profile("network"):
+                response = self.transport.get(api_url, cache=False)
+        except requests.exceptions.RequestException as e:
+            self.instrumentation.event("live", outcome="request_error", error=redact(e), **event)
+            print(f"Live request failed: {redact(e)}")
+            return None
+        event.update(status=response.status_code, latency_seconds=round(time.perf_counter() - request_start, 6),
+                     bytes=len(response.content))
+
+        if response.status_code != 200:
+            # No points left: stop the ingestion instead of failing every request from now on
+            outcome = "payment_required" if response.status_code == 402 else "http_error"
+            self.instrumentation.event("live", outcome=outcome, **event)
+            print(f"Live request failed with status {response.status_code}")
+            if response.status_code == 402:
+                self.stop_event.set()
+            return None
+
+        parse_start = time.perf_counter()
+        with self.instrumentation.profile("parse"):
+            json_data = json.loads(response.content)
+            table = self._decode(json_data)
+
+            # Keep the readings newer than the latest stored time stamp of their sensor
+            sensors = table['sensor_index'].to_pylist()
+            time_stamps = table['time_stamp'].to_pylist()
+            keep = [time_stamp is not None and time_stamp > self.latest.get(sensor, -1)
+                    for sensor, time_stamp in zip(sensors, time_stamps)]
+            now = time.time()
+            lags = []
+            for sensor, time_stamp, new in zip(sensors, time_stamps, keep):
+                if new:
+                    self.latest[sensor] = time_stamp
+                    lags.append(now - time_stamp)
+            table = table.filter(pa.array(keep, type=pa.bool_()))
+
+        if table.num_rows:
+            self.buffer.append(table)
+            self.buffered_rows += table.num_rows
+        self.instrumentation.observe("purpleair_live_lag_seconds", lags, buckets=LAG_BUCKETS)
+        api_lag = json_data.get("time_stamp", 0) - json_data.get("data_time_stamp", json_data.get("time_stamp", 0))
+        self.instrumentation.event("live", outcome="data" if lags else "no_data", rows=len(lags),
+                                   duplicates=len(keep) - len(lags), api_lag_seconds=api_lag,
+                                   parse_seconds=round(time.perf_counter() - parse_start, 6), **event)
+        return lags
+
+    def flush(self):
+        """Append the buffered rows to the store and compact the partitions with compact_chunks chunks or more."""
+        import pyarrow as pa
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return []
+        table = pa.concat_tables(self.buffer)
+        self.buffer = []
+        self.buffered_rows = 0
+
+        write_start = time.perf_counter()
+        with self.instrumentation.profile("write"):
+            partitions = self.store.append(table)
+        write_seconds = time.perf_counter() - write_start
+
+        merge_start = time.perf_counter()
+        with self.instrumentation.profile("merge"):
+            compacted = [partition for partition in partitions
+                         if len(self.store.partition_files(*partition)) >= self.compact_chunks]
+            for sensor, month in compacted:
+                self.store.compact_partition(sensor, month)
+        self.instrumentation.event("live_flush", flushed_rows=table.num_rows, partitions=len(partitions),
+                                   compacted=len(compacted), write_seconds=round(write_seconds, 6),
+                                   merge_seconds=round(time.perf_counter() - merge_start, 6) if compacted else None)
+        return partitions
+
+    def poll(self):
+        """Poll every sensor once, batch by batch. Returns the number of new readings."""
+        import numpy as np
+        cycle_start = time.perf_counter()
+        lags = []
+        failed = 0
+        for start in range(0, len(self.sensors), self.batch_size):
+            if self.stop_event.is_set():
+                break
+            batch_lags = self.poll_batch(self.sensors[start:start + self.batch_size])
+            if batch_lags is None:
+                failed += 1
+                continue
+            lags += batch_lags
+            if self.buffered_rows >= self.flush_rows:
+                self.flush()
+        if time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+        self.cycles += 1
+
+        cycle_seconds = time.perf_counter() - cycle_start
+        max_lag = max(lags) if lags else None
+        median_lag = float(np.median(lags)) if lags else None
+        gauges = {"cycle_seconds": round(cycle_seconds, 3), "new_readings": len(lags),
+                  "failed_requests": failed, "buffered_rows": self.buffered_rows,
+                  "last_cycle_timestamp": round(time.time(), 3)}
+        if lags:
+            gauges.update(max_lag_seconds=round(max_lag, 3), median_lag_seconds=round(median_lag, 3))
+        for name, value in gauges.items():
+            self.instrumentation.set_gauge(f"purpleair_live_{name}", value)
+        self.instrumentation.event("live_cycle", cycle=self.cycles, sensors=len(self.sensors), **gauges)
+        self.instrumentation.flush()
+
+        print(f"Cycle {self.cycles}: {len(lags)} new readings of {len(self.sensors)} sensors in {cycle_seconds:.1f} s" +
+              (f", lag median {median_lag:.0f} s, max {max_lag:.0f} s" if lags else "") +
+              (f", {failed} failed requests" if failed else ""))
+        return len(lags)
+
+    def run(self, max_cycles=None):
+        """
+        Poll every interval seconds until stop() is called, the API points run out or max_cycles cycles ran.
+        The buffered rows are flushed on the way out, also on KeyboardInterrupt.
+        """
+        print(f"Live ingestion: {len(self.sensors)} sensors every {self.interval} s, "
+              f"{-(-len(self.sensors) // self.batch_size)} requests per cycle, {self.bucket.rate:.3f} requests/s")
+        next_cycle = time.monotonic()
+        try:
+            while not self.stop_event.is_set():
+                self.poll()
+                if max_cycles is not None and self.cycles >= max_cycles:
+                    break
+                # Next cycle on schedule, or right away when this one overran the interval
+                next_cycle = max(next_cycle + self.interval, time.monotonic())
+                self.stop_event.wait(next_cycle - time.monotonic())
+        finally:
+            self.flush()
+            self.instrumentation.flush()
+
+    def stop(self):
+        """Stop after the current request (e.g. from a SIGTERM handler)."""
+        self.stop_event.set()
+
+# Configuration file of the command line, also set with --config or PA_CONFIG
+CONFIG_PATH = 'purple_air.json'
+
+# Settings of the command line. Each one can be set in the config file (JSON, same keys),
+# in the environment as PA_<KEY> (e.g. PA_API_KEY, PA_BDATE) or with a flag; flags win over
+# the environment, which wins over the file.
+DEFAULT_CONFIG = {
+    "api_key": None,                        # PurpleAir read key
+    "bdate": "2021-01-01",                  # download period
+    "edate": "2021-01-15",
+    "average_time": 10,                     # average in minutes: 0, 10 or 60
+    "sleep_seconds": 3,                     # at least sleep_seconds between queries, shared by all workers
+    "max_workers": 4,                       # sensors downloaded at the same time
+    "download_dir": "processed",
+    "log_file_path": LOG_FILE_PATH,
+    "skip_rules_path": SKIP_RULES_PATH,
+    "sensors": [131255, 182, 1234, 1302],   # sensor indices, or groups: all, us_indoor, us_outdoor, non_us
+    "points_budget": None,
+    "adaptive_windows": False,
+    "replay_only": False,
+    "n_shards": 0,                          # sharded run: number of shards of the whole array
+    "shard_id": None,                       # this shard (default: SLURM_ARRAY_TASK_ID)
+    "live_interval": 120,                   # live: seconds between polls of all sensors
+    "live_batch_size": LIVE_BATCH_SIZE      # live: sensors per request
+}
+
+def _parse_bool(value):
+    return value if isinstance(value, bool) else str(value).lower() in ("1", "true", "yes", "on")
+
+def _parse_sensors(value):
+    # A list of sensor indices, or group names of get_sensorslist
+    items = value if isinstance(value, list) else [item.strip() for item in str(value).split(",") if item.strip()]
+    return [int(item) if str(item).isdigit() else item for item in items]
+
+_CONFIG_TYPES = {"average_time": int, "sleep_seconds": float, "max_workers": int, "points_budget": int,
+                 "adaptive_windows": _parse_bool, "replay_only": _parse_bool, "sensors": _parse_sensors,
+                 "n_shards": int, "shard_id": int, "live_interval": float, "live_batch_size": int}
+
+def load_config(config_path=None, overrides=None):
+    """
+    Settings of the command line: DEFAULT_CONFIG, updated by the config file, the PA_* environment
+    variables (empty ones are ignored) and the overrides (the flags that were given), in this order. The
+    default config file is optional; a file given with config_path or PA_CONFIG that does not exist raises
+    FileNotFoundError.
+    """
+    config = dict(DEFAULT_CONFIG)
+    explicit_path = config_path or os.environ.get("PA_CONFIG")
+    config_path = explicit_path or CONFIG_PATH
+    if explicit_path and not os.path.exists(config_path):
+        raise FileNotFoundError(f"Config file not found: {config_path}")
+    if os.path.exists(config_path):
+        with open(config_path, 'r') as config_file:
+            config.update(json.load(config_file))
+    # Empty variables (e.g. PA_N_SHARDS= in a job script) count as unset
+    for key in DEFAULT_CONFIG:
+        if os.environ.get(f"PA_{key.upper()}", "").strip():
+            config[key] = os.environ[f"PA_{key.upper()}"]
+    if config["shard_id"] is None and os.environ.get("SLURM_ARRAY_TASK_ID", "").strip():
+        config["shard_id"] = os.environ["SLURM_ARRAY_TASK_ID"]
+    config.update({key: value for key, value in (overrides or {}).items() if value is not None})
+    
+    for key, parse in _CONFIG_TYPES.items():
+        if config[key] is not None:
+            config[key] = parse(config[key])
+    return config
+
+def _resolve_sensors(config, read_only=False):
+    # Group names are looked up in the sensor index (downloaded first if there is none). With read_only,
+    # a missing index is an error and the index is read without writing its cache
+    groups = [item for item in config["sensors"] if isinstance(item, str)]
+    sensors = [item for item in config["sensors"] if not isinstance(item, str)]
+    if groups:
+        index_path = os.path.join(config["download_dir"], "sensors_index.csv")
+        if read_only:
+            if not os.path.exists(index_path):
+                sys.exit(f"No sensor index at {index_path}: run `purple_air.py refresh-index --full` first.")
+            sensor_dict = SensorIndex.from_csv(index_path).groups()
+        else:
+            sensor_dict = get_sensorslist(key_read=config["api_key"], download_dir=config["download_dir"],
+                                          log_file_path=config["log_file_path"])
+        for group in groups:
+            sensors += sum(sensor_dict.values(), []) if group == "all" else sensor_dict[group]
+    return sorted(set(sensors))
+
+def _sharded(config):
+    return bool(config["n_shards"]) and config["shard_id"] is not None
+
+def _instrumentation(config):
+    # Per-request trace and metrics; PA_PROFILE_DIR also profiles each stage with cProfile
+    profile_dir = os.environ.get("PA_PROFILE_DIR")
+    shard_id = config["shard_id"]
+    if _sharded(config):
+        return Instrumentation(trace_path=f"logs/purple_air_trace_shard_{shard_id:04d}.jsonl",
+                               metrics_path=f"logs/purple_air_shard_{shard_id:04d}.prom",
+                               profile_dir=profile_dir and os.path.join(profile_dir, f"shard_{shard_id:04d}"),
+                               labels={"shard": shard_id})
+    return Instrumentation(trace_path=TRACE_PATH, metrics_path=METRICS_PATH, profile_dir=profile_dir)
+
+def _require_api_key(config):
+    if not config["api_key"] and not config["replay_only"]:
+        sys.exit("An API key is required: set PA_API_KEY, api_key in the config file, or --api-key.")
+
+def command_refresh_index(config, args):
+    """Download (--full) or incrementally refresh the sensor index."""
+    _require_api_key(config)
+    with _instrumentation(config) as instrumentation:
+        if args.full:
+            get_sensors(config["api_key"], download_dir=config["download_dir"], instrumentation=instrumentation,
+                        log_file_path=config["log_file_path"])
+        else:
+            refresh_sensors(config["api_key"], download_dir=config["download_dir"],
+                            log_file_path=config["log_file_path"], instrumentation=instrumentation)
+
+def command_plan(config, args):
+    """Print the download plan (requests, points, sensor-days, wall time) without downloading or writing anything."""
+    get_historicaldata(_resolve_sensors(config, read_only=True), config["bdate"], config["edate"],
+                       config["average_time"], config["api_key"], config["sleep_seconds"],
+                       download_dir=config["download_dir"], log_file_path=config["log_file_path"],
+                       skip_rules_path=config["skip_rules_path"], points_budget=config["points_budget"],
+                       adaptive_windows=config["adaptive_windows"], dry_run=True)
+
+def command_prepare(config, args):
+    """Once before a sharded download: get the sensor index, create the download log and migrate old CSV files."""
+    if any(isinstance(item, str) for item in config["sensors"]):
+        _require_api_key(config)
+        _resolve_sensors(config)
+    open_sensor_log(config["log_file_path"]).close()
+    migrate_csv_history(config["download_dir"])
+
+def command_download(config, args):
+    """Download the history, then update the QA dataset and the rollups of the new windows."""
+    _require_api_key(config)
+    # Array tasks share the sensor index: downloading it is left to the prepare step, not raced by every task
+    index_path = os.path.join(config["download_dir"], "sensors_index.csv")
+    if _sharded(config) and any(isinstance(item, str) for item in config["sensors"]) and not os.path.exists(index_path):
+        sys.exit(f"No sensor index at {index_path}: run `purple_air.py prepare` before the sharded download.")
+    sensors = _resolve_sensors(config)
+    download_dir = config["download_dir"]
+    options = dict(max_workers=config["max_workers"], skip_rules_path=config["skip_rules_path"],
+                   points_budget=config["points_budget"], adaptive_windows=config["adaptive_windows"])
+    
+    # Plan the windows of permanent errors again
+    if args.retry_failed:
+        log_paths = [config["log_file_path"]]
+        if _sharded(config):
+            log_paths.append(shard_log_path(config["n_shards"], config["shard_id"]))
+        for log_path in log_paths:
+            if os.path.exists(log_path):
+                with SensorLog(log_path) as sensor_log:
+                    print(f"Cleared {sensor_log.clear_failed(sensors)} failed intervals in {log_path}")
+    
+    with _instrumentation(config) as instrumentation:
+        # One task of a SLURM job array: download its shard of the sensor list
+        if _sharded(config):
+            stats = run_shard(config["api_key"], sensors, config["bdate"], config["edate"], config["average_time"],
+                              config["n_shards"], config["shard_id"], requests_per_second=1 / config["sleep_seconds"],
+                              download_dir=download_dir, log_file_path=config["log_file_path"],
+                              instrumentation=instrumentation, **options)
+            # Rollups of the regions are updated by the merge step, once all shards are done
+            run_qa(download_dir, partitions=stats["partitions"])
+            return
         
-        # Example list of sensors for demonstration
-        sample_sensors = [131255, 182, 1234, 1302]
-
-        # Get historical data for the sample sensors
-        get_historicaldata(
-            sensors_list=sample_sensors,
-            bdate=bdate,
-            edate=edate,
-            average_time=average_time,
-            key_read=key_read,
-            sleep_seconds=sleep_seconds,
-            download_dir = download_dir
-        )
+        stats = get_historicaldata(sensors, config["bdate"], config["edate"], config["average_time"],
+                                   config["api_key"], config["sleep_seconds"], download_dir=download_dir,
+                                   log_file_path=config["log_file_path"], instrumentation=instrumentation, **options)
+    
+    # QA flags and corrected PM2.5 of the partitions that received new windows
+    run_qa(download_dir, partitions=stats["partitions"])
+    
+    # Hourly and daily rollups of the buckets touched by the new windows
+    update_rollups(download_dir, partitions=stats["partitions"])
 
+def command_status(config, args):
+    """Print the state of the download log, and of the shards of a sharded run."""
+    log_file_path = config["log_file_path"]
+    if not os.path.exists(log_file_path):
+        print(f"No download log at {log_file_path}")
+        return
+    with SensorLog(log_file_path) as sensor_log:
+        summary = sensor_log.summary()
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(f"Download log: {log_file_path}")
+        print(f"Sensors: {summary['sensors']} ({summary['sensors_with_data']} with data, {summary['sensors_skipped']} skipped)")
+        print(f"Rows downloaded: {summary['rows']}")
+        for kind, coverage in summary["coverage"].items():
+            print(f"Coverage {kind}: {coverage['windows']} windows, {coverage['sensor_days']} sensor-days")
+        print(f"URL issues: {summary['url_issues']}, windows without data: {summary['no_data_windows']}")
+        print(f"Sensor index time stamp: {summary['sensors_index_time_stamp']}")
+    if config["n_shards"]:
+        failed = failed_shards(config["n_shards"])
+        print(f"Shards done: {config['n_shards'] - len(failed)} of {config['n_shards']}" +
+              (f"; to run again: {','.join(str(shard_id) for shard_id in failed)}" if failed else ""))
+
+def command_merge(config, args):
+    """Merge the shard logs into the global log and update the rollups; exits with 1 if shards failed."""
+    if not config["n_shards"] or config["n_shards"] < 1:
+        sys.exit("Nothing to merge: set the number of shards of the run with PA_N_SHARDS or --n-shards.")
+    failed = merge_shard_logs(config["n_shards"], config["log_file_path"])
+    update_rollups(config["download_dir"])
+    sys.exit(1 if failed else 0)
+
+def command_live(config, args):
+    """Poll the latest readings of the sensors until stopped (Ctrl-C or SIGTERM) and append them to the store."""
+    _require_api_key(config)
+    if config["replay_only"]:
+        sys.exit("Live ingestion needs the network: it cannot run in replay-only mode.")
+    with _instrumentation(config) as instrumentation:
+        ingest = LiveIngest(config["api_key"], _resolve_sensors(config), interval=config["live_interval"],
+                            batch_size=config["live_batch_size"], requests_per_second=1 / config["sleep_seconds"],
+                            download_dir=config["download_dir"], instrumentation=instrumentation)
+        # SLURM and systemd stop a job with SIGTERM: finish the current request and flush the buffer
+        signal.signal(signal.SIGTERM, lambda signum, frame: ingest.stop())
+        try:
+            ingest.run(max_cycles=args.max_cycles)
+        except KeyboardInterrupt:
+            print("Live ingestion stopped")
+
+def _add_settings(parser, default=None):
+    # Settings shared by the subcommands; unset flags leave the config file and environment in place
+    parser.add_argument("--config", default=default, help=f"JSON config file (default: $PA_CONFIG or {CONFIG_PATH})")
+    parser.add_argument("--api-key", dest="api_key", default=default)
+    parser.add_argument("--bdate", default=default, help="first day of the download period, YYYY-MM-DD")
+    parser.add_argument("--edate", default=default, help="end of the download period, YYYY-MM-DD")
+    parser.add_argument("--average-time", dest="average_time", type=int, default=default,
+                        help="average in minutes: 0, 10 or 60")
+    parser.add_argument("--sleep-seconds", dest="sleep_seconds", type=float, default=default)
+    parser.add_argument("--max-workers", dest="max_workers", type=int, default=default)
+    parser.add_argument("--download-dir", dest="download_dir", default=default)
+    parser.add_argument("--log-file", dest="log_file_path", default=default)
+    parser.add_argument("--skip-rules", dest="skip_rules_path", default=default)
+    parser.add_argument("--sensors", default=default,
+                        help="comma separated sensor indices or groups (all, us_indoor, us_outdoor, non_us)")
+    parser.add_argument("--points-budget", dest="points_budget", type=int, default=default)
+    parser.add_argument("--adaptive-windows", dest="adaptive_windows", action="store_true", default=default)
+    parser.add_argument("--replay-only", dest="replay_only", action="store_true", default=default,
+                        help="serve every request from the response cache")
+    parser.add_argument("--n-shards", dest="n_shards", type=int, default=default)
+    parser.add_argument("--shard-id", dest="shard_id", type=int, default=default)
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="purple_air.py", description="Download PurpleAir sensor data. "
+                                     "Without a subcommand, runs download.")
+    # Settings may come before the subcommand (e.g. --config my.json status) or after it. The subcommands
+    # leave out the settings they were not given, so that they keep those given before the subcommand
+    _add_settings(parser)
+    settings = argparse.ArgumentParser(add_help=False)
+    _add_settings(settings, default=argparse.SUPPRESS)
+    
+    subparsers = parser.add_subparsers(dest="command")
+    refresh = subparsers.add_parser("refresh-index", parents=[settings], help=command_refresh_index.__doc__)
+    refresh.add_argument("--full", action="store_true", help="download the whole sensor list")
+    refresh.set_defaults(handler=command_refresh_index)
+    subparsers.add_parser("plan", parents=[settings], help=command_plan.__doc__).set_defaults(handler=command_plan)
+    subparsers.add_parser("prepare", parents=[settings], help=command_prepare.__doc__).set_defaults(handler=command_prepare)
+    download = subparsers.add_parser("download", parents=[settings], help=command_download.__doc__)
+    download.add_argument("--retry-failed", action="store_true",
+                          help="download the windows recorded as permanent errors again")
+    download.set_defaults(handler=command_download)
+    status = subparsers.add_parser("status", parents=[settings], help=command_status.__doc__)
+    status.add_argument("--json", action="store_true", help="print the summary as JSON")
+    status.set_defaults(handler=command_status)
+    subparsers.add_parser("merge", parents=[settings], help=command_merge.__doc__).set_defaults(handler=command_merge)
+    live = subparsers.add_parser("live", parents=[settings], help=command_live.__doc__)
+    live.add_argument("--interval", dest="live_interval", type=float, help="seconds between polls (default: 120)")
+    live.add_argument("--batch-size", dest="live_batch_size", type=int,
+                      help=f"sensors per request (default: {LIVE_BATCH_SIZE})")
+    live.add_argument("--max-cycles", type=int, help="stop after this many polls")
+    live.set_defaults(handler=command_live)
+    # Without a subcommand, download (as earlier versions of this script did)
+    parser.set_defaults(command="download", handler=command_download, retry_failed=False)
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    
+    overrides = {key: value for key, value in vars(args).items() if key in DEFAULT_CONFIG}
+    try:
+        config = load_config(args.config, overrides)
+    except FileNotFoundError as e:
+        sys.exit(str(e))
+    if config["replay_only"]:
+        set_transport(PurpleAirTransport(replay_only=True))
+    
+    try:
+        args.handler(config, args)
     except requests.exceptions.RequestException as e:
-        print(f"Request error: {e}")
-    except pd.errors.EmptyDataError:
-        print("Data error: No data returned or file is empty.")
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        sys.exit(f"Request error: {redact(e)}")
+    except ValueError as e:
+        # pandas is imported by the commands that read data: if it is not loaded, none of them ran
+        pandas = sys.modules.get("pandas")
+        if pandas is None or not isinstance(e, pandas.errors.EmptyDataError):
+            raise
+        sys.exit("Data error: No data returned or file is empty.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
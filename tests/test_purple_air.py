@@ -0,0 +1,315 @@
+"""
+Tests of purple_air.py: interval and download planning, skip rules, the download log, the sensor
+index and the HTTP error paths of get_historicaldata against the local mock API
+(benchmarks/mock_purpleair.py). No API key or network access is needed.
+
+Run from the repository root:
+
+    python -m pytest
+"""
+
+import json
+import sqlite3
+
+import pytest
+
+import purple_air
+from purple_air import (SensorLog, SensorIndex, SkipRules, create_pa_datelist, merge_intervals,
+                        open_sensor_log, plan_downloads, subtract_intervals, _iso_to_epoch)
+from mock_purpleair import start_mock_server
+
+DAY = 86400
+
+def epoch(date):
+    return _iso_to_epoch(f"{date}T00:00:00Z")
+
+# Interval merging
+
+@pytest.mark.parametrize("intervals, merged", [
+    ([], []),
+    ([(5, 10)], [(5, 10)]),
+    ([(20, 30), (0, 10)], [(0, 10), (20, 30)]),
+    ([(0, 10), (5, 15)], [(0, 15)]),
+    ([(0, 10), (10, 20)], [(0, 20)]),
+    ([(0, 100), (10, 20), (30, 40)], [(0, 100)]),
+    ([(30, 40), (0, 10), (5, 35)], [(0, 40)]),
+])
+def test_merge_intervals(intervals, merged):
+    assert merge_intervals(intervals) == merged
+
+def test_subtract_intervals():
+    assert subtract_intervals(0, 100, []) == [(0, 100)]
+    assert subtract_intervals(0, 100, [(10, 20), (50, 60)]) == [(0, 10), (20, 50), (60, 100)]
+    assert subtract_intervals(0, 100, [(-10, 30), (90, 120)]) == [(30, 90)]
+    assert subtract_intervals(0, 100, [(0, 100)]) == []
+
+# Download planning
+
+@pytest.fixture
+def sensor_log(tmp_path):
+    with SensorLog(str(tmp_path / "sensor_log.sqlite")) as log:
+        yield log
+
+def test_create_pa_datelist_is_newest_first():
+    dates = create_pa_datelist(10, "2021-01-01", "2021-01-21")
+    assert dates == ["2021-01-21T00:00:00Z", "2021-01-16T00:00:00Z", "2021-01-11T00:00:00Z",
+                     "2021-01-06T00:00:00Z", "2021-01-01T00:00:00Z"]
+
+def test_plan_downloads_leaves_out_covered_windows(sensor_log):
+    dates = create_pa_datelist(10, "2021-01-01", "2021-01-21")
+    windows = [(dates[i + 1], dates[i]) for i in range(len(dates) - 1)]
+    sensor_log.add_coverage(1, "data", "2021-01-16T00:00:00Z", "2021-01-21T00:00:00Z")
+    sensor_log.add_coverage(1, "no_data", "2021-01-06T00:00:00Z", "2021-01-11T00:00:00Z")
+    sensor_log.add_coverage(2, "failed", "2021-01-01T00:00:00Z", "2021-01-21T00:00:00Z")
+
+    plan = plan_downloads([1, 2, 3], dates, sensor_log)
+    assert plan == {1: [windows[1], windows[3]], 3: windows}
+
+def test_plan_downloads_needs_the_whole_window_covered(sensor_log):
+    dates = create_pa_datelist(10, "2021-01-01", "2021-01-06")
+    sensor_log.add_coverage(1, "data", "2021-01-01T00:00:00Z", "2021-01-05T00:00:00Z")
+    assert plan_downloads([1], dates, sensor_log) == {1: [("2021-01-01T00:00:00Z", "2021-01-06T00:00:00Z")]}
+
+    # Adjacent ranges of different kinds cover it together
+    sensor_log.add_coverage(1, "no_data", "2021-01-05T00:00:00Z", "2021-01-06T00:00:00Z")
+    assert plan_downloads([1], dates, sensor_log) == {}
+
+def test_clear_failed_plans_the_windows_again(sensor_log):
+    dates = create_pa_datelist(10, "2021-01-01", "2021-01-06")
+    sensor_log.add_coverage(1, "failed", "2021-01-01T00:00:00Z", "2021-01-06T00:00:00Z")
+    assert plan_downloads([1], dates, sensor_log) == {}
+    sensor_log.clear_failed([1])
+    assert 1 in plan_downloads([1], dates, sensor_log)
+
+# Skip rules
+
+def test_skip_rules_apply(sensor_log):
+    rules = SkipRules([
+        {"name": "indoor", "sensors": [1, 2], "start": "2021-01-01", "end": "2021-01-11", "reason": "done"},
+        {"name": "everyone", "start": "2021-01-21", "end": "2021-01-21"},
+    ])
+    dates = create_pa_datelist(10, "2021-01-01", "2021-01-21")
+    plan = plan_downloads([1, 3], dates, sensor_log)
+    removed_windows = []
+    result, removed = rules.apply(plan, sensor_log, removed_windows)
+
+    # Windows ending inside [start, end], both dates included, are removed
+    assert result == {1: [("2021-01-11T00:00:00Z", "2021-01-16T00:00:00Z")],
+                      3: [("2021-01-11T00:00:00Z", "2021-01-16T00:00:00Z"),
+                          ("2021-01-06T00:00:00Z", "2021-01-11T00:00:00Z"),
+                          ("2021-01-01T00:00:00Z", "2021-01-06T00:00:00Z")]}
+    assert removed == {"indoor": 2, "everyone": 2}
+    assert (1, "2021-01-16T00:00:00Z", "2021-01-21T00:00:00Z", "everyone") in removed_windows
+    assert len(removed_windows) == 4
+    assert sorted(sensor_log.skipped_sensors()) == [1, 3]
+
+def test_skip_rules_from_missing_config_removes_nothing(tmp_path):
+    rules = SkipRules.from_config(str(tmp_path / "missing.json"))
+    plan = {1: [("2021-01-01T00:00:00Z", "2021-01-06T00:00:00Z")]}
+    assert rules.apply(plan) == (plan, {})
+
+def test_skip_rules_sensors_file(tmp_path):
+    sensors_file = tmp_path / "indoor.csv"
+    sensors_file.write_text("sensor_index,name\n7,a\n8,b\n")
+    rules = SkipRules([{"name": "file", "sensors_file": str(sensors_file), "start": "2020-01-01", "end": "2022-01-01"}])
+    plan = {7: [("2021-01-01T00:00:00Z", "2021-01-06T00:00:00Z")], 9: [("2021-01-01T00:00:00Z", "2021-01-06T00:00:00Z")]}
+    result, removed = rules.apply(plan)
+    assert list(result) == [9]
+    assert removed == {"file": 1}
+
+# Download log: import of sensor_log.json and upgrade of older logs
+
+LEGACY_LOG = {
+    "sensors_index.csv file last updated": "2023-05-01",
+    "sensors_skipped": [3],
+    "1": {"min_date": "2021_01_01", "max_date": "2021_01_10", "url_issue": ["HTTP error: 500"],
+          "no_data": ["2021-02-01T00:00:00Z to 2021-02-06T00:00:00Z"]},
+    "2": {"min_date": None, "max_date": None},
+}
+
+def test_import_json(tmp_path):
+    json_path = tmp_path / "sensor_log.json"
+    json_path.write_text(json.dumps(LEGACY_LOG))
+    with open_sensor_log(str(tmp_path / "sensor_log.sqlite"), legacy_log_file_path=str(json_path)) as log:
+        assert log.get_meta("sensors_index.csv file last updated") == "2023-05-01"
+        assert log.skipped_sensors() == [3]
+        entry = log.get_sensor(1)
+        assert (entry["min_date"], entry["max_date"]) == ("2021_01_01", "2021_01_10")
+        assert entry["url_issue"] == ["HTTP error: 500"]
+        # Coverage is rebuilt from the dates (max_date included) and the no_data windows
+        assert log.coverage([1]) == {1: [(epoch("2021-01-01"), epoch("2021-01-11")),
+                                         (epoch("2021-02-01"), epoch("2021-02-06"))]}
+        assert log.coverage([2]) == {}
+
+def test_import_json_only_into_a_new_log(tmp_path):
+    json_path = tmp_path / "sensor_log.json"
+    json_path.write_text(json.dumps(LEGACY_LOG))
+    log_path = str(tmp_path / "sensor_log.sqlite")
+    SensorLog(log_path).close()
+    with open_sensor_log(log_path, legacy_log_file_path=str(json_path)) as log:
+        assert log.get_sensor(1) is None
+
+def test_upgrade_of_an_older_log(tmp_path):
+    # A log written before the coverage index and the row counts existed
+    log_path = str(tmp_path / "sensor_log.sqlite")
+    conn = sqlite3.connect(log_path)
+    conn.executescript("""
+        CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE sensors (sensor_index INTEGER PRIMARY KEY, min_date TEXT, max_date TEXT,
+                              skipped INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE url_issue (sensor_index INTEGER NOT NULL, message TEXT NOT NULL);
+        CREATE TABLE no_data (sensor_index INTEGER NOT NULL, window TEXT NOT NULL,
+                              PRIMARY KEY (sensor_index, window));
+        INSERT INTO sensors (sensor_index, min_date, max_date) VALUES (5, '2021_03_01', '2021_03_02');
+        INSERT INTO no_data VALUES (5, '2021-03-10T00:00:00Z to 2021-03-15T00:00:00Z');
+    """)
+    conn.commit()
+    conn.close()
+
+    # Read-only opens see the upgraded log without changing the file
+    with SensorLog(log_path, read_only=True) as log:
+        assert log.coverage([5]) == {5: [(epoch("2021-03-01"), epoch("2021-03-03")),
+                                         (epoch("2021-03-10"), epoch("2021-03-15"))]}
+        log.add_coverage(6, "data", "2021-01-01T00:00:00Z", "2021-01-02T00:00:00Z")
+    conn = sqlite3.connect(log_path)
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'coverage'").fetchone() is None
+    conn.close()
+
+    with SensorLog(log_path) as log:
+        assert log.coverage([5, 6]) == {5: [(epoch("2021-03-01"), epoch("2021-03-03")),
+                                            (epoch("2021-03-10"), epoch("2021-03-15"))]}
+        log.add_rows(5, 288, DAY)
+    conn = sqlite3.connect(log_path)
+    assert conn.execute("SELECT rows, row_seconds FROM sensors WHERE sensor_index = 5").fetchone() == (288, DAY)
+    conn.close()
+
+# Sensor index
+
+@pytest.fixture
+def index_path(tmp_path):
+    # Sensors around the antimeridian, near the pole, one without coordinates and one removed
+    rows = [
+        (1, 10.0, 179.5, 0, 0, 0),
+        (2, 10.5, -179.5, 1, 0, 0),
+        (3, 11.0, 0.5, 0, 0, 0),
+        (4, -45.0, 170.0, 0, 0, 0),
+        (5, 89.9, 45.0, 0, 0, 0),
+        (6, "", "", 0, 0, 0),
+        (7, 10.2, 179.9, 0, 0, 1),
+        (8, 40.0, -100.0, 0, 1, 0),
+    ]
+    path = tmp_path / "sensors_index.csv"
+    lines = ["sensor_index,name,latitude,longitude,location_type,us,removed"]
+    lines += [f"{sensor},s{sensor},{latitude},{longitude},{location_type},{us},{removed}"
+              for sensor, latitude, longitude, location_type, us, removed in rows]
+    path.write_text("\n".join(lines) + "\n")
+    return str(path)
+
+def test_sensor_index_bbox(index_path):
+    index = SensorIndex.from_csv(index_path)
+    assert index.select(bbox=(0, 10, 1, 12)).tolist() == [3]
+    assert index.select(bbox=(-180, -90, 180, 90)).tolist() == [1, 2, 3, 4, 5, 8]
+    assert index.select(bbox=(-180, -90, 180, 90), include_removed=True).tolist() == [1, 2, 3, 4, 5, 7, 8]
+
+def test_sensor_index_bbox_across_the_antimeridian(index_path):
+    index = SensorIndex.from_csv(index_path)
+    assert index.select(bbox=(179, 9, -179, 12)).tolist() == [1, 2]
+    assert index.select(bbox=(160, -50, -170, 20)).tolist() == [1, 2, 4]
+
+def test_sensor_index_radius(index_path):
+    index = SensorIndex.from_csv(index_path)
+    # About 110 km between sensors 1 and 2, across the antimeridian
+    assert index.select(center=(10.0, 179.9), radius_km=50).tolist() == [1]
+    assert index.select(center=(10.0, 179.9), radius_km=150).tolist() == [1, 2]
+    assert index.select(center=(10.0, 179.9), radius_km=150, location_type=1).tolist() == [2]
+    # A circle around the pole covers every longitude
+    assert index.select(center=(89.0, -135.0), radius_km=200).tolist() == [5]
+
+def test_sensor_index_groups(index_path):
+    groups = SensorIndex.from_csv(index_path).groups()
+    # Sensors without coordinates count as outside the U.S.; removed sensors are left out
+    assert groups == {"us_indoor": [], "us_outdoor": [8], "non_us": [1, 2, 3, 4, 5, 6]}
+
+def test_sensor_index_cache(index_path, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    built = SensorIndex.load(index_path, cache_dir=cache_dir)
+    cached = SensorIndex.load(index_path, cache_dir=cache_dir)
+    assert (tmp_path / "cache" / "sensors_index.arrow").exists()
+    assert cached.table.schema.metadata == built.table.schema.metadata
+    assert cached.sensor_index.tolist() == built.sensor_index.tolist()
+    assert cached.cell.tolist() == built.cell.tolist()
+    assert cached.select(bbox=(179, 9, -179, 12)).tolist() == [1, 2]
+
+    # A changed CSV rebuilds the cache
+    with open(index_path, "a") as index_file:
+        index_file.write("9,s9,10.1,-179.9,0,0,0\n")
+    assert SensorIndex.load(index_path, cache_dir=cache_dir).select(bbox=(179, 9, -179, 12)).tolist() == [1, 2, 9]
+
+# HTTP error statuses of get_historicaldata, against the mock API
+
+@pytest.fixture
+def mock_api(monkeypatch, tmp_path):
+    servers = []
+
+    def start(**config):
+        server, mock_config, api_root = start_mock_server(n_sensors=20, **config)
+        servers.append(server)
+        monkeypatch.setattr(purple_air, "API_ROOT_URL", api_root)
+        return mock_config
+
+    monkeypatch.chdir(tmp_path)
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def download(sensors, key="KEY", bdate="2021-01-01", edate="2021-01-21"):
+    transport = purple_air.PurpleAirTransport(cache_dir=None, retries=0)
+    return purple_air.get_historicaldata(sensors, bdate, edate, 10, key, None, download_dir="processed",
+                                         log_file_path="sensor_log.sqlite", skip_rules_path=None, transport=transport)
+
+def remaining(sensors, bdate="2021-01-01", edate="2021-01-21"):
+    with SensorLog("sensor_log.sqlite") as log:
+        return plan_downloads(sensors, create_pa_datelist(10, bdate, edate), log)
+
+def test_download(mock_api):
+    mock_api()
+    stats = download([1, 2])
+    assert (stats["requests"], stats["rows"], stats["errors"], stats["stopped"]) == (8, 5760, 0, False)
+    assert stats["partitions"] == [(1, "2021-01"), (2, "2021-01")]
+    assert remaining([1, 2]) == {}
+    assert len(purple_air.load_history([1, 2], download_dir="processed")) == 5760
+
+def test_not_found_fails_every_window_of_the_sensor(mock_api):
+    mock_api()
+    stats = download([404, 1])
+    assert stats["stopped"] is False
+    assert stats["requests"] == 5
+    assert remaining([404, 1]) == {}
+    with SensorLog("sensor_log.sqlite") as log:
+        assert log.coverage([404], kinds=("failed",)) == {404: [(epoch("2021-01-01"), epoch("2021-01-21"))]}
+        assert log.coverage([1], kinds=("failed",)) == {}
+
+def test_payment_required_stops_the_run(mock_api):
+    mock_api(payment_after=2)
+    stats = download([1, 2])
+    assert stats["stopped"] is True
+    assert stats["rows"] == 2 * 720
+    # Windows that were not downloaded are planned again, not recorded as failed
+    left = remaining([1, 2])
+    assert sum(len(windows) for windows in left.values()) == 6
+    with SensorLog("sensor_log.sqlite") as log:
+        assert log.coverage([1, 2], kinds=("failed",)) == {}
+
+@pytest.mark.parametrize("status", [401, 403])
+def test_rejected_key_stops_the_run(mock_api, status):
+    mock_api(rejected_keys={"BAD": status})
+    stats = download([1, 2, 3], key="BAD")
+    assert stats["stopped"] is True
+    assert stats["rows"] == 0
+    # One request per worker at most, and every window is still to download
+    assert stats["requests"] == 1
+    assert remaining([1, 2, 3]) == {sensor: [(f"2021-01-{day:02d}T00:00:00Z", f"2021-01-{day + 5:02d}T00:00:00Z")
+                                             for day in (16, 11, 6, 1)] for sensor in [1, 2, 3]}
+    with SensorLog("sensor_log.sqlite") as log:
+        assert log.summary()["url_issues"] == 0